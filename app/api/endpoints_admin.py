@@ -1,35 +1,85 @@
+import asyncio
 import logging
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from sqlalchemy import delete, update
 from dotenv import load_dotenv
 import os
-from app.database.database import get_db
-from app.models.models_ingredients import IngredientPreference
+from app.database import invalidation
+from app.database.sharding import shards
+from app.models.models_ingredients import IngredientPreference, UserPreferencesVersion
+from app.utils.cache import preferences_cache
+from app.utils.metrics import registry as metrics
+from app.utils import profiling
 
 router = APIRouter()
 logger = logging.getLogger("admin")
 
-@router.delete("/clean-database", status_code=200)
-async def clean_database(secret_key: str, db: AsyncSession = Depends(get_db)):
-    """
-    Deletes all data from the database (for testing purposes).
-    Requires a secret key for security.
-    """
-    load_dotenv()    
+def verify_secret_key(secret_key: str):
+    """Raises a 403 error if the secret key does not match the configured one"""
+    load_dotenv()
 
     if secret_key != os.getenv("CLEAN_DATABASE_PASSWORD"):
         logger.warning(f"{logger.name}: Invalid secret key provided")
         raise HTTPException(status_code=403, detail="Invalid secret key")
 
-    # Delete all records in the table
-    slct_ret = select(IngredientPreference)
-    ret = await db.execute(slct_ret)
-    for record in ret.scalars():
-        db.delete(record)
-    await db.commit()
+async def _clean_shard(shard):
+    async with shards.session(shard=shard) as db:
+        # Delete all records in the table
+        ret = await db.execute(delete(IngredientPreference))
+        # Invalidate the ETags of the preferences reads
+        await db.execute(update(UserPreferencesVersion).values(version=UserPreferencesVersion.version + 1))
+        await invalidation.publish_flush(db)
+        await db.commit()
+        return ret.rowcount
+
+@router.delete("/clean-database", status_code=200)
+async def clean_database(secret_key: str):
+    """
+    Deletes all data from the database, in every shard (for testing purposes).
+    Requires a secret key for security.
+    """
+    verify_secret_key(secret_key)
+
+    deleted = await asyncio.gather(*(_clean_shard(shard) for shard in shards.engines))
+    preferences_cache.clear()
 
-    message = "Database cleaned successfully. Deleted records: " + str(ret)
+    message = "Database cleaned successfully. Deleted records: " + str(sum(deleted))
     logger.info(message)
     
     return {"message": message}
+
+
+@router.get("/metrics", status_code=200)
+async def read_metrics(secret_key: str):
+    """
+    Returns the service metrics (counters, gauges and latency summaries) of the worker handling the request.
+    Requires a secret key for security.
+    """
+    verify_secret_key(secret_key)
+
+    return metrics.snapshot()
+
+
+@router.get("/profiles", status_code=200)
+async def list_profiles(secret_key: str):
+    """
+    Lists the request profiles saved by the profiling middleware (sampled and slow requests), newest first.
+    Requires a secret key for security.
+    """
+    verify_secret_key(secret_key)
+
+    return profiling.list_profiles()
+
+@router.get("/profiles/{name}", status_code=200)
+async def read_profile(name: str, secret_key: str):
+    """
+    Downloads a request profile, in speedscope format (it can be opened as a flamegraph in https://www.speedscope.app).
+    Requires a secret key for security.
+    """
+    verify_secret_key(secret_key)
+
+    path = profiling.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=name)
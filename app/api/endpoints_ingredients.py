@@ -1,37 +1,118 @@
+import hashlib
 import logging
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.schemas import schema_ingredients as schemas
 from app.crud import ingredient_preferences_crud as crud
-from app.database.database import get_db
+from app.crud import ingredient_preferences_bulk as bulk_crud
+from app.crud import group_commit
+from app.api.endpoints_admin import verify_secret_key
+from app.database.sharding import get_user_db, shards
+from app.utils.cache import preferences_cache
 
 router = APIRouter()
 logger = logging.getLogger("ingredient_preference")
 logger.setLevel(logging.INFO)
 
+def _etag(*parts):
+    """Builds the (strong) ETag of a representation from the parts identifying it (user, preferences version, ingredient...)"""
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest() + '"'
+
+def _is_not_modified(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    client_etags = [client_etag.strip().removeprefix("W/") for client_etag in if_none_match.split(",")]
+    return "*" in client_etags or etag in client_etags
+
+async def _conditional_read(request: Request, response: Response, db: AsyncSession, user_id: int, *representation):
+    """Checks the If-None-Match header against the current version of the user's preferences, with a single cheap lookup.
+
+    Returns:
+        Response: a 304 response if the client's representation is up to date, None otherwise (the ETag is then set in the response)
+    """
+    # The version is read before the rows: a write in between only makes the client fetch the rows again on the next poll. It is
+    # cached (and evicted on writes), so that up-to-date clients do not hit the database at all
+    version = await preferences_cache.get_or_load(user_id, "version", lambda: crud.get_preferences_version(db, user_id))
+    etag = _etag(user_id, version, *representation)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return None
+
 @router.post("/", response_model=schemas.IngredientPreferenceOut, status_code=status.HTTP_201_CREATED)
 async def create_ingredient_preference(
-    preference: schemas.IngredientPreferenceCreate, 
-    db: AsyncSession = Depends(get_db)
+    preference: schemas.IngredientPreferenceCreate
 ):
     logger.info("Creating ingredient preference for user %s and ingredient '%s'", preference.user_id, preference.ingredient)
-    return await crud.create_ingredient(db, preference)
+    if group_commit.GROUP_COMMIT_ENABLED:
+        return await group_commit.create_ingredient(preference)
+    # The user comes in the body, so the session of its shard is opened here instead of in a dependency
+    async with shards.session(preference.user_id) as db:
+        return await crud.create_ingredient(db, preference)
+
+@router.post("/import", response_model=schemas.IngredientPreferencesImportResult)
+async def import_ingredient_preferences(
+    request: Request,
+    secret_key: str,
+    format: schemas.BulkFormat = schemas.BulkFormat.ndjson
+):
+    """
+    Imports preferences in bulk from an NDJSON or CSV (with a user_id,ingredient,preference header) request body.
+    Existing preferences are left unchanged, and contradictory ones are reported as conflicts.
+    Writes the preferences of any user, so the admin secret key is required.
+    """
+    verify_secret_key(secret_key)
+    logger.info("Importing ingredient preferences (%s)", format.value)
+    return await bulk_crud.import_preferences(shards, request.stream(), format)
+
+@router.get("/export")
+async def export_ingredient_preferences(
+    format: schemas.BulkFormat = schemas.BulkFormat.ndjson,
+    user_id: int = Query(None, gt=0),
+    secret_key: str = None
+):
+    """
+    Exports the preferences (of a single user or of all of them) as an NDJSON or CSV stream.
+    Exporting all the users requires the admin secret key.
+    """
+    if user_id is None:
+        verify_secret_key(secret_key)
+    logger.info("Exporting ingredient preferences (%s) of %s", format.value, f"user {user_id}" if user_id else "all users")
+    media_type = "text/csv" if format == schemas.BulkFormat.csv else "application/x-ndjson"
+    return StreamingResponse(
+        bulk_crud.export_preferences(shards, format, user_id),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="ingredient_preferences.{format.value}"'}
+    )
 
 @router.get("/", response_model=list[schemas.IngredientPreferenceOut])
 async def read_ingredients(
+    request: Request,
+    response: Response,
     user_id: int = Query(..., gt=0), 
     skip: int = 0, 
     limit: int = 100, 
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_user_db)
 ):
+    not_modified = await _conditional_read(request, response, db, user_id, skip, limit)
+    if not_modified is not None:
+        return not_modified
     return await crud.list_ingredients(db, user_id, skip, limit)
 
 @router.get("/{ingredient}", response_model=schemas.IngredientPreferenceOut)
 async def read_ingredient(
+    request: Request,
+    response: Response,
     ingredient: str, 
     user_id: int = Query(..., gt=0), 
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_user_db)
 ):
+    not_modified = await _conditional_read(request, response, db, user_id, ingredient)
+    if not_modified is not None:
+        return not_modified
     record = await crud.get_ingredient(db, user_id, ingredient)
     if not record:
         raise HTTPException(
@@ -45,16 +126,18 @@ async def update_ingredient_preference(
     ingredient: str, 
     update: schemas.IngredientPreferenceUpdate,
     user_id: int = Query(..., gt=0), 
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_user_db)
 ):
     logger.info("Updating ingredient '%s' for user %s", ingredient, user_id)
+    if group_commit.GROUP_COMMIT_ENABLED:
+        return await group_commit.update_ingredient(user_id, ingredient, update)
     return await crud.update_ingredient(db, user_id, ingredient, update)
 
 @router.delete("/{ingredient}", response_model=schemas.IngredientPreferenceOut)
 async def delete_ingredient_preference(
     ingredient: str, 
     user_id: int = Query(..., gt=0), 
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_user_db)
 ):
     logger.info("Deleting ingredient '%s' for user %s", ingredient, user_id)
     return await crud.delete_ingredient(db, user_id, ingredient)
\ No newline at end of file
@@ -1,11 +1,23 @@
+import asyncio
+import json
 import logging
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, Query
+import os
+import time
+from typing import Annotated, List
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from openai import LengthFinishReasonError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from app.database.database import get_db
-from pydantic import BaseModel
-from app.utils.llm import GenericLLM
+from app.database.sharding import get_user_db
+from app.utils.admission import admit_recipes_request
+from pydantic import BaseModel, ValidationError
+from app.utils.llm import GenericLLM, ModelRouter, OpenAI_Generic
+from app.utils.llm_generations import ClientDisconnected, generation_key, run_generation
+from app.utils.llm_scheduler import RequestPriority
+from app.utils.cache import preferences_cache
+from app.utils.metrics import registry as metrics
+from app.utils.recipes_validation import UnexpectedStructuredOutput, drop_near_duplicates, split_recipes
 import app.utils.llm_prompts as llm_prompts
 import app.schemas.schema_recipes as schemas_recipes
 
@@ -15,32 +27,182 @@ router = APIRouter()
 logger = logging.getLogger("recipes")
 logger.setLevel(logging.INFO)
 
-@router.get("/", response_model=schemas_recipes.RecipeList)
+load_dotenv()
+# Whether to stream the generations from the LLM backend (both modes are aborted on client disconnect)
+LLM_STREAM_RESPONSES = os.getenv("LLM_STREAM_RESPONSES", "false").lower() == "true"
+
+# Max number of malformed recipes of a response repaired with a follow-up LLM call (the rest are dropped)
+LLM_MAX_RECIPE_REPAIRS = int(os.getenv("LLM_MAX_RECIPE_REPAIRS", "2"))
+
+# Default generation mode of the recipes: "single" (all the recipes in one LLM call) or "parallel" (one concurrent call per recipe)
+LLM_RECIPES_GENERATION_MODE = schemas_recipes.RecipesGenerationMode(os.getenv("LLM_RECIPES_GENERATION_MODE", "single"))
+# How the recipes of the parallel mode are chosen: "llm" (a short planning call for distinct titles) or "fixed" (a fixed diversity scheme)
+LLM_RECIPES_PLANNING = schemas_recipes.RecipesPlanning(os.getenv("LLM_RECIPES_PLANNING", "llm"))
+
+model_router = ModelRouter.from_env()
+
+# Errors of an invalid structured output (truncated, not JSON, not following the schema), as opposed to configuration or backend errors
+INVALID_OUTPUT_ERRORS = (ValidationError, json.JSONDecodeError, UnexpectedStructuredOutput, LengthFinishReasonError)
+
+async def _structured_generation(request, model, system_prompt, inst_prompt, response_schema, max_new_tokens, user_id, priority):
+    formatted_prompt = OpenAI_Generic.build_prompt(system_prompt, None, inst_prompt)
+
+    async def generate():
+        # The LLM client is only created (and closed) by the generation, which may be shared: the requests waiting for it create none
+        llm = GenericLLM(model, sync_client=False)
+        try:
+            return await llm.agenerate_structured_response(formatted_prompt, response_schema, 0.6, max_new_tokens, stream=LLM_STREAM_RESPONSES)
+        finally:
+            await llm.aclose()
+
+    return await run_generation(request, generation_key(model, formatted_prompt, 0.6, max_new_tokens), generate, user_id, priority)
+
+async def repair_recipe(request, model, item, validation_error, user_id = None, priority = RequestPriority.interactive):
+    """Asks the LLM to fix a malformed recipe in a short follow-up call
+
+    Returns:
+        Recipe: the fixed recipe, or None if it could not be fixed
+    """
+    inst_prompt = llm_prompts.RECIPE_REPAIR_INST.format(recipe=json.dumps(item), errors=validation_error)
+    try:
+        llm_response = await _structured_generation(request, model, llm_prompts.RECIPE_REPAIR_SYS, inst_prompt, schemas_recipes.Recipe, 1024, user_id, priority)
+        return schemas_recipes.Recipe.model_validate(llm_response)
+    except INVALID_OUTPUT_ERRORS as e:
+        logger.warning(f"Could not repair malformed recipe generated by {model}: {e}")
+        return None
+
+async def generate_recipes(request, model, preferences, user_id = None, priority = RequestPriority.interactive):
+    """Generates the recipes for the given ingredient preferences with the given model, aborting the generation if the client disconnects
+
+    Args:
+        request (Request): incoming request (None if the client connection must not be watched)
+        model (str): model to use
+        preferences (dict): ingredient -> preference mapping
+        user_id (int, optional): user the LLM capacity is scheduled for. Defaults to None (anonymous).
+        priority (RequestPriority, optional): scheduling priority of the LLM calls. Defaults to interactive.
+
+    Returns:
+        RecipeList: generated recipes
+    """
+    # TODO: Add in-context learning to improve results
+    inst_prompt = llm_prompts.RECIPES_GENERATION_INST_STRUCTURED.format(preferences=preferences)
+    structured_llm_response = await _structured_generation(request, model, llm_prompts.RECIPES_GENERATION_SYS, inst_prompt, schemas_recipes.RecipeList, 4096, user_id, priority)
+
+    # Keep the valid recipes, repairing (up to a limit) or dropping the malformed ones instead of regenerating everything
+    recipes, invalid_items = split_recipes(structured_llm_response)
+    if invalid_items:
+        to_repair = invalid_items[:LLM_MAX_RECIPE_REPAIRS]
+        repaired = await asyncio.gather(*(repair_recipe(request, model, item, error, user_id, priority) for item, error in to_repair))
+        repaired = [recipe for recipe in repaired if recipe is not None]
+        recipes += repaired
+        metrics.inc("recipes_repaired_total", len(repaired), tier=model)
+        metrics.inc("recipes_dropped_total", len(invalid_items) - len(repaired), tier=model)
+        logger.info(f"{len(invalid_items)} malformed recipes generated by {model}: {len(repaired)} repaired, {len(invalid_items) - len(repaired)} dropped")
+
+    return schemas_recipes.RecipeList(recipes)
+
+async def plan_recipes(request, model, preferences, user_id = None, priority = RequestPriority.interactive):
+    """Chooses the (distinct) recipes to generate in parallel: titles given by a short planning call, or the fixed diversity scheme
+
+    Returns:
+        list of str: descriptions of the recipes to generate (an empty list if no recipes can be generated)
+    """
+    if LLM_RECIPES_PLANNING == schemas_recipes.RecipesPlanning.fixed:
+        return list(llm_prompts.RECIPE_DIVERSITY_STYLES)
+
+    inst_prompt = llm_prompts.RECIPES_PLANNING_INST.format(preferences=preferences)
+    llm_response = await _structured_generation(request, model, llm_prompts.RECIPES_PLANNING_SYS, inst_prompt, schemas_recipes.RecipePlan, 256, user_id, priority)
+    titles = drop_near_duplicates(schemas_recipes.RecipePlan.model_validate(llm_response).titles)[:5]
+
+    return [f'titled "{title}"' for title in titles]
+
+async def generate_recipe(request, model, preferences, recipe, user_id = None, priority = RequestPriority.interactive):
+    """Generates a single planned recipe, repairing it if it is malformed
+
+    Returns:
+        Recipe: the generated recipe, or None if it could not be generated
+    """
+    inst_prompt = llm_prompts.RECIPE_GENERATION_INST.format(recipe=recipe, preferences=preferences)
+    try:
+        llm_response = await _structured_generation(request, model, llm_prompts.RECIPES_GENERATION_SYS, inst_prompt, schemas_recipes.Recipe, 1024, user_id, priority)
+    except INVALID_OUTPUT_ERRORS as e:
+        logger.warning(f"Could not generate recipe {recipe} with {model}: {e}")
+        metrics.inc("recipes_dropped_total", tier=model)
+        return None
+    try:
+        return schemas_recipes.Recipe.model_validate(llm_response)
+    except ValidationError as e:
+        repaired = await repair_recipe(request, model, llm_response, e, user_id, priority)
+        metrics.inc("recipes_repaired_total" if repaired is not None else "recipes_dropped_total", tier=model)
+        return repaired
+
+async def generate_recipes_parallel(request, model, preferences, user_id = None, priority = RequestPriority.interactive):
+    """Generates the recipes in parallel: a short planning call chooses distinct recipes, each one of which is then generated in its
+    own concurrent LLM call. The latency is about the one of a single recipe instead of the one of all of them, at the cost of
+    repeating the prompt (input tokens) in every call. Same arguments and result as generate_recipes.
+    """
+    planned_recipes = await plan_recipes(request, model, preferences, user_id, priority)
+    recipes = await asyncio.gather(*(generate_recipe(request, model, preferences, recipe, user_id, priority) for recipe in planned_recipes))
+    # Different calls may still come up with the same recipe
+    recipes = drop_near_duplicates([recipe for recipe in recipes if recipe is not None], key=lambda recipe: recipe.name)
+
+    return schemas_recipes.RecipeList(recipes)
+
+
+@router.get("/", response_model=schemas_recipes.RecipeList, dependencies=[Depends(admit_recipes_request)])
 async def create_recipes(
     user_id: int = Query(..., gt=0), 
     ingredients: List[str] = Query(..., min_length=3), 
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_user_db),
+    request: Request = None,
+    priority: Annotated[RequestPriority, Query(description="Batch/background requests are served after the interactive ones")] = RequestPriority.interactive,
+    mode: Annotated[schemas_recipes.RecipesGenerationMode | None, Query(description="Generate the recipes in a single LLM call or in parallel calls (one per recipe)")] = None
 ):
-    preferences_select = select(IngredientPreference).filter(
-        IngredientPreference.user_id == user_id,
-        IngredientPreference.ingredient.in_(ingredients)
-    )
-    result = await db.execute(preferences_select)
-    preferences = result.scalars().all()
+    async def load_preferences():
+        # All the preferences of the user are cached (and evicted on writes), whatever the ingredients of the request
+        result = await db.execute(select(IngredientPreference.ingredient, IngredientPreference.preference).filter(IngredientPreference.user_id == user_id))
+        return {ingredient: preference.value for ingredient, preference in result.all()}
+
+    user_preferences = await preferences_cache.get_or_load(user_id, "preferences", load_preferences)
     # Create a mapping of ingredient -> preference
-    preference_map = {p.ingredient: p.preference.value for p in preferences}
+    preference_map = {ingredient: user_preferences[ingredient] for ingredient in ingredients if ingredient in user_preferences}
     if PreferenceEnum.disliked in preference_map.values():
         logger.warning(f"Tried to generate recipes for user {user_id} with disliked ingredients")
         raise HTTPException(status_code=400, detail="Cannot generate recipes with disliked ingredients")
     # Add "no preference" for ingredients that were not found
     result = {ingredient: preference_map.get(ingredient, "no preference") for ingredient in ingredients}
-  
-    # TODO: Add in-context learning to improve results
-    llm = GenericLLM()
-    formatted_prompt = llm.build_prompt(llm_prompts.RECIPES_GENERATION_SYS, None, llm_prompts.RECIPES_GENERATION_INST_STRUCTURED.format(preferences=result))
-    structured_llm_response = llm.generate_structured_response(formatted_prompt, schemas_recipes.RecipeList, 0.6, 4096)
-    recipe_list_obj = schemas_recipes.RecipeList.model_validate(structured_llm_response)
-    
+
+    generate = generate_recipes_parallel if (mode or LLM_RECIPES_GENERATION_MODE) == schemas_recipes.RecipesGenerationMode.parallel else generate_recipes
+
+    # Go through the model tiers, escalating to the next one when the result is invalid or empty
+    tiers = model_router.route(user_id, len(ingredients))
+    for tier_index, model in enumerate(tiers):
+        is_last_tier = tier_index == len(tiers) - 1
+        metrics.inc("llm_tier_requests_total", tier=model)
+        start = time.perf_counter()
+        try:
+            recipe_list_obj = await generate(request, model, result, user_id, priority)
+        except ClientDisconnected:
+            logger.info(f"Client disconnected while generating recipes for user {user_id}, generation aborted")
+            raise HTTPException(status_code=499, detail="Client closed request")
+        except INVALID_OUTPUT_ERRORS as e:
+            metrics.inc("llm_tier_failures_total", tier=model)
+            if is_last_tier:
+                raise
+            logger.warning(f"Invalid recipes generated by {model} for user {user_id}, escalating to {tiers[tier_index + 1]}: {e}")
+            metrics.inc("llm_tier_escalations_total", tier=model)
+            continue
+        finally:
+            metrics.observe("llm_tier_latency_seconds", time.perf_counter() - start, tier=model)
+
+        if any(recipe_list_obj.root):
+            metrics.inc("llm_tier_successes_total", tier=model)
+            break
+        metrics.inc("llm_tier_empty_total", tier=model)
+        if not is_last_tier:
+            logger.info(f"No recipes generated by {model} for user {user_id}, escalating to {tiers[tier_index + 1]}")
+            metrics.inc("llm_tier_escalations_total", tier=model)
+
     if not any(recipe_list_obj.root):
         logger.warning(f"No recipes generated for user {user_id} with ingredients {ingredients}")
         raise HTTPException(status_code=400, detail="No recipes found for the given ingredients. Please try again with different ingredients.")
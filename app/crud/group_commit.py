@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_
+from sqlalchemy.future import select
+from app.crud.ingredient_preferences_crud import dialect_insert
+from app.database import invalidation
+from app.database.sharding import shards
+from app.models.models_ingredients import IngredientPreference, PreferenceEnum, UserPreferencesVersion
+from app.schemas.schema_ingredients import IngredientPreferenceCreate, IngredientPreferenceUpdate
+from app.utils.cache import preferences_cache
+from app.utils.metrics import registry as metrics
+
+load_dotenv()
+# Whether the preference creations/updates are committed in groups (write-behind) instead of one transaction each
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+# Max seconds a write waits for other writes to be committed with, and max writes committed together
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", "0.005"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "256"))
+
+logger = logging.getLogger("group_commit")
+
+
+class _Write:
+    def __init__(self, kind, user_id, ingredient, preference) -> None:
+        self.kind = kind
+        self.key = (user_id, ingredient)
+        self.preference = preference
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class GroupCommitWriter:
+    """Commits the preference writes of many concurrent requests together: the writes received within a short window (or up to a
+    max batch size) are applied in order, coalescing the repeated writes of the same (user, ingredient), and flushed as a single
+    multi-row upsert in a single transaction (one fsync instead of one per write).
+
+    Each write gets the same result or error as with ingredient_preferences_crud (as if the writes of the batch had been executed one
+    after the other), and only once the shared transaction is committed. The existing preferences are locked while the batch is
+    applied, and the new ones are inserted without overwriting the ones other transactions may have inserted in the meantime.
+    """
+    def __init__(self, session_factory, window = GROUP_COMMIT_WINDOW, max_batch = GROUP_COMMIT_MAX_BATCH) -> None:
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def submit(self, kind, user_id, ingredient, preference):
+        """Submits a write, waiting for its group to be committed
+
+        Args:
+            kind (str): "create" or "update"
+            user_id (int): user of the preference
+            ingredient (str): ingredient of the preference
+            preference (PreferenceEnum): new preference
+
+        Raises:
+            HTTPException: same errors as create_ingredient/update_ingredient (contradictory preference, not found)
+
+        Returns:
+            IngredientPreference: the written (or existing) preference
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        write = _Write(kind, user_id, ingredient, preference.value)
+        await self._queue.put(write)
+        return await write.future
+
+    async def _next_batch(self):
+        """Waits for the next group of writes
+
+        Returns:
+            tuple: writes of the group, whether the writer was closed
+        """
+        write = await self._queue.get()
+        if write is None:
+            return [], True
+        batch = [write]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                write = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if write is None:
+                return batch, True
+            batch.append(write)
+        return batch, False
+
+    async def _run(self):
+        closed = False
+        while not closed:
+            batch, closed = await self._next_batch()
+            if not batch:
+                continue
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+                for write in batch:
+                    if not write.future.done():
+                        write.future.set_exception(e)
+
+    def _apply(self, batch, existing):
+        """Applies the writes in order to the snapshot of the existing preferences
+
+        Returns:
+            tuple: results of the writes (the preference each one left, or its exception), final preference of the written keys
+        """
+        state = {key: row.preference.value for key, row in existing.items()}
+        results, written = [], {}
+        for write in batch:
+            if write.key not in state:
+                if write.kind == "update":
+                    results.append(HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ingredient not found for the given user."))
+                    continue
+            elif write.kind == "create":
+                # Same rules as create_ingredient: repeating a preference is a no-op, contradicting it is an error
+                if state[write.key] != write.preference:
+                    results.append(HTTPException(status_code=400, detail="Contradictory preference detected."))
+                else:
+                    results.append(state[write.key])
+                continue
+            state[write.key] = write.preference
+            written[write.key] = write.preference
+            results.append(write.preference)
+        return results, written
+
+    async def _lock_existing(self, db, keys):
+        """Reads (and locks until the commit, so that no other transaction updates or deletes them) the existing preferences
+
+        Returns:
+            dict: (user_id, ingredient) -> IngredientPreference
+        """
+        existing_select = select(IngredientPreference).filter(
+            tuple_(IngredientPreference.user_id, IngredientPreference.ingredient).in_(keys)
+        ).order_by(IngredientPreference.user_id, IngredientPreference.ingredient).with_for_update()
+        return {(row.user_id, row.ingredient): row for row in (await db.execute(existing_select)).scalars()}
+
+    async def _insert_new(self, db, preferences):
+        """Inserts new preferences, skipping the ones inserted by another transaction in the meantime
+
+        Returns:
+            dict: (user_id, ingredient) -> IngredientPreference, of the inserted preferences only
+        """
+        insert_stmt = dialect_insert(db)(IngredientPreference).values([
+            {"user_id": user_id, "ingredient": ingredient, "preference": preferences[(user_id, ingredient)]} for user_id, ingredient in sorted(preferences)
+        ]).on_conflict_do_nothing(index_elements=["user_id", "ingredient"]).returning(IngredientPreference)
+        return {(row.user_id, row.ingredient): row for row in (await db.execute(insert_stmt)).scalars()}
+
+    async def _flush(self, batch):
+        start = time.perf_counter()
+        keys = list({write.key for write in batch})
+        async with self.session_factory() as db:
+            existing = await self._lock_existing(db, keys)
+            rows = dict(existing)
+            results, written = [None] * len(batch), {}
+            pending = list(range(len(batch)))
+            while pending:
+                pending_results, pending_written = self._apply([batch[i] for i in pending], existing)
+                for i, result in zip(pending, pending_results):
+                    results[i] = result
+                new_preferences = {key: preference for key, preference in pending_written.items() if key not in existing}
+                inserted = await self._insert_new(db, new_preferences) if new_preferences else {}
+                rows.update(inserted)
+                # Preferences inserted by another transaction since the snapshot: the writes of their keys are applied again on top
+                # of them, as create_ingredient would have done (e.g. a contradictory create is then rejected)
+                conflicted = set(new_preferences) - set(inserted)
+                written.update({key: preference for key, preference in pending_written.items() if key not in conflicted})
+                if conflicted:
+                    locked = await self._lock_existing(db, list(conflicted))
+                    existing.update(locked)
+                    rows.update(locked)
+                pending = [i for i in pending if batch[i].key in conflicted]
+
+            # The rest of the written preferences exist, and are locked
+            updated = {key: preference for key, preference in written.items() if key in existing}
+            if updated:
+                update_stmt = dialect_insert(db)(IngredientPreference).values([
+                    {"user_id": user_id, "ingredient": ingredient, "preference": updated[(user_id, ingredient)]} for user_id, ingredient in sorted(updated)
+                ])
+                update_stmt = update_stmt.on_conflict_do_update(
+                    index_elements=["user_id", "ingredient"], set_={"preference": update_stmt.excluded.preference}
+                ).returning(IngredientPreference).execution_options(populate_existing=True)
+                for row in (await db.execute(update_stmt)).scalars():
+                    rows[(row.user_id, row.ingredient)] = row
+
+            if written:
+                # A single version bump (and invalidation) per user of the batch
+                insert = dialect_insert(db)
+                users = sorted({user_id for user_id, _ in written})
+                bump_stmt = insert(UserPreferencesVersion).values([{"user_id": user_id, "version": 1} for user_id in users])
+                bump_stmt = bump_stmt.on_conflict_do_update(
+                    index_elements=[UserPreferencesVersion.user_id], set_={"version": UserPreferencesVersion.version + 1}
+                ).returning(UserPreferencesVersion.user_id, UserPreferencesVersion.version)
+                for user_id, version in (await db.execute(bump_stmt)).all():
+                    await invalidation.publish(db, user_id, version)
+            await db.commit()
+
+        # The writes are committed: resolve them before anything else can fail
+        for write, result in zip(batch, results):
+            if write.future.done():
+                continue
+            if isinstance(result, Exception):
+                write.future.set_exception(result)
+            else:
+                # Detached copies holding the preference this very write left (not the final one of the batch)
+                row = rows[write.key]
+                write.future.set_result(IngredientPreference(id=row.id, user_id=row.user_id, ingredient=row.ingredient, preference=PreferenceEnum(result)))
+
+        for user_id in {user_id for user_id, _ in written}:
+            preferences_cache.evict_user(user_id)
+        metrics.observe("group_commit_batch_size", len(batch))
+        metrics.observe("group_commit_flush_seconds", time.perf_counter() - start)
+        metrics.inc("group_commit_coalesced_total", len(batch) - len(written) - sum(isinstance(result, Exception) for result in results))
+
+    async def close(self):
+        """Commits the pending writes and stops the writer"""
+        if self._task is not None and not self._task.done():
+            await self._queue.put(None)
+            await self._task
+        self._task = None
+
+
+# A writer per shard (each group is committed in the database of its users)
+writers = {shard: GroupCommitWriter(lambda shard=shard: shards.session(shard=shard)) for shard in shards.engines}
+
+
+async def create_ingredient(igredient_data: IngredientPreferenceCreate):
+    """Group-committed version of ingredient_preferences_crud.create_ingredient"""
+    writer = writers[shards.shard_for(igredient_data.user_id)]
+    return await writer.submit("create", igredient_data.user_id, igredient_data.ingredient, igredient_data.preference)
+
+
+async def update_ingredient(user_id: int, igredient_name: str, update_data: IngredientPreferenceUpdate):
+    """Group-committed version of ingredient_preferences_crud.update_ingredient"""
+    return await writers[shards.shard_for(user_id)].submit("update", user_id, igredient_name, update_data.preference)
+
+
+async def close_writers():
+    for writer in writers.values():
+        await writer.close()
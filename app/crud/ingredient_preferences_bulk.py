@@ -0,0 +1,378 @@
+import codecs
+import csv
+import io
+import json
+import logging
+import os
+from collections import deque
+from contextlib import AsyncExitStack
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from sqlalchemy import text, tuple_
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.future import select
+from app.database.invalidation import INVALIDATION_CHANNEL
+from app.database.sharding import ShardedDatabase
+from app.models.models_ingredients import IngredientPreference, UserPreferencesVersion
+from app.schemas.schema_ingredients import BulkFormat, IngredientPreferenceCreate, IngredientPreferencesImportResult
+from app.utils.cache import preferences_cache
+from app.utils.metrics import registry as metrics
+
+load_dotenv()
+# Rows loaded (COPY + merge) or exported at a time, bounding the memory used by the bulk operations
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "10000"))
+# Max number of invalid rows reported back in the import summary
+MAX_REPORTED_ERRORS = 20
+# Max number of (user_id, ingredient) keys looked up per query in the embedded SQLite mode (bound parameters are limited)
+SQLITE_KEYS_PER_QUERY = 500
+CSV_COLUMNS = ["user_id", "ingredient", "preference"]
+# Max number of characters of a record (CSV records can span several lines), bounding the memory used by malformed streams (e.g. a
+# never closed quoted field): longer records are reported as invalid
+MAX_RECORD_SIZE = 65536
+
+logger = logging.getLogger("ingredient_preference_bulk")
+
+STAGING_TABLE = "ingredient_preferences_staging"
+_CREATE_STAGING_TABLE = f"""
+CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (
+    line BIGINT NOT NULL,
+    user_id INTEGER NOT NULL,
+    ingredient VARCHAR NOT NULL,
+    preference VARCHAR NOT NULL
+)"""
+# Merges the staged rows following the uix_user_ingredient rules of create_ingredient: new preferences are inserted, existing ones
+# with the same preference are left unchanged and contradictory ones are rejected. The versions of the users are bumped in the same
+# statement (data-modifying CTEs are always executed) and published to the workers' caches on commit, and the conflicts are counted
+# against the rows existing before the batch
+_MERGE_STAGING_TABLE = f"""
+WITH batch AS (
+    SELECT DISTINCT ON (user_id, ingredient) user_id, ingredient, CAST(preference AS {{enum_type}}) AS preference
+    FROM {STAGING_TABLE}
+    ORDER BY user_id, ingredient, line
+), inserted AS (
+    INSERT INTO ingredient_preferences (user_id, ingredient, preference)
+    SELECT user_id, ingredient, preference FROM batch
+    ON CONFLICT ON CONSTRAINT uix_user_ingredient DO NOTHING
+    RETURNING user_id
+), bumped AS (
+    INSERT INTO user_preferences_versions (user_id, version)
+    SELECT DISTINCT user_id, 1 FROM inserted
+    ON CONFLICT (user_id) DO UPDATE SET version = user_preferences_versions.version + 1
+    RETURNING user_id, version
+)
+SELECT
+    (SELECT count(*) FROM {STAGING_TABLE}) AS staged,
+    (SELECT count(*) FROM batch) AS distinct_rows,
+    (SELECT count(*) FROM inserted) AS inserted,
+    (SELECT count(*) FROM batch JOIN ingredient_preferences existing
+        ON existing.user_id = batch.user_id AND existing.ingredient = batch.ingredient
+        WHERE existing.preference <> batch.preference) AS conflicts,
+    (SELECT count(pg_notify('{INVALIDATION_CHANNEL}', user_id || ':' || version)) FROM bumped) AS notified
+"""
+
+
+async def _lines(byte_chunks, max_length = None):
+    """Splits a stream of bytes into lines, decoding it incrementally. Lines longer than max_length are yielded as None (they are
+    not buffered)"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    too_long = False
+    async for chunk in byte_chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            if too_long or (max_length is not None and len(line) > max_length):
+                too_long = False
+                yield None
+            else:
+                yield line
+        if max_length is not None and len(pending) > max_length:
+            too_long = True
+            pending = ""
+    pending += decoder.decode(b"", final=True)
+    if too_long or (max_length is not None and len(pending) > max_length):
+        yield None
+    elif pending:
+        yield pending
+
+
+class _LineBuffer:
+    """Iterator over the lines received so far, consumed by a csv.reader. Unlike a generator, it can be refilled after running out"""
+    def __init__(self) -> None:
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+def _ends_in_quoted_field(line, in_quoted_field):
+    """Tells whether a CSV line ends inside a quoted field (the record then goes on with the next line), following the parser of the
+    csv module (default dialect): a quote only opens a quoted field at the start of the field (elsewhere it is a literal character),
+    and a doubled quote inside a quoted field is an escaped quote
+
+    Args:
+        line (str): line, without its newline
+        in_quoted_field (bool): whether the line starts inside a quoted field of the previous line
+
+    Returns:
+        bool: whether the line ends inside a quoted field
+    """
+    at_field_start = True
+    closing_quote = False
+    for char in line:
+        if in_quoted_field:
+            if closing_quote:
+                closing_quote = False
+                if char == '"':
+                    continue
+                # The quoted field is over, the rest of it (if any) is unquoted
+                in_quoted_field = False
+            else:
+                closing_quote = char == '"'
+                continue
+        if char == ",":
+            at_field_start = True
+        elif char == '"' and at_field_start:
+            in_quoted_field = True
+            at_field_start = False
+        else:
+            at_field_start = False
+
+    return in_quoted_field and not closing_quote
+
+
+async def _csv_records(byte_chunks):
+    """Parses a CSV stream with a single csv.reader, so that quoted fields can span several lines. The reader is only asked for
+    records once all of their lines were received (i.e. the last line does not end inside a quoted field)
+
+    Yields:
+        tuple: line number where the record starts, values of the record (None if invalid), error message (None if valid)
+    """
+    buffer = _LineBuffer()
+    reader = csv.reader(buffer)
+    line_number = 0
+    record_size = 0
+    in_quoted_field = False
+    async for line in _lines(byte_chunks, MAX_RECORD_SIZE):
+        line_number += 1
+        if line is None or record_size + len(line) + 1 > MAX_RECORD_SIZE:
+            record_line_number = line_number - len(buffer.lines)
+            buffer.lines.clear()
+            record_size = 0
+            in_quoted_field = False
+            yield record_line_number, None, f"Line {record_line_number}: record longer than {MAX_RECORD_SIZE} characters"
+            continue
+
+        buffer.lines.append(line + "\n")
+        record_size += len(line) + 1
+        in_quoted_field = _ends_in_quoted_field(line, in_quoted_field)
+        if in_quoted_field:
+            continue
+        while buffer.lines:
+            record_line_number = line_number - len(buffer.lines) + 1
+            try:
+                yield record_line_number, next(reader), None
+            except csv.Error as e:
+                buffer.lines.clear()
+                yield record_line_number, None, f"Line {record_line_number}: {e}"
+        record_size = 0
+
+    if buffer.lines:
+        record_line_number = line_number - len(buffer.lines) + 1
+        yield record_line_number, None, f"Line {record_line_number}: unclosed quoted field"
+
+
+async def _ndjson_records(byte_chunks):
+    line_number = 0
+    async for line in _lines(byte_chunks, MAX_RECORD_SIZE):
+        line_number += 1
+        if line is None:
+            yield line_number, None, f"Line {line_number}: record longer than {MAX_RECORD_SIZE} characters"
+            continue
+        try:
+            yield line_number, json.loads(line) if line.strip() else None, None
+        except ValueError as e:
+            yield line_number, None, f"Line {line_number}: {e}"
+
+
+async def _parse_preferences(byte_chunks, bulk_format):
+    """Parses and validates the preferences of an NDJSON or CSV (with header) stream, one record at a time
+
+    Yields:
+        tuple: line number, IngredientPreferenceCreate (None if invalid), error message (None if valid)
+    """
+    columns = None
+    records = _csv_records(byte_chunks) if bulk_format == BulkFormat.csv else _ndjson_records(byte_chunks)
+    async for line_number, record, error in records:
+        if error is not None:
+            yield line_number, None, error
+            continue
+        # Blank lines
+        if not record:
+            continue
+        if bulk_format == BulkFormat.csv:
+            if columns is None:
+                columns = [column.strip() for column in record]
+                if not set(CSV_COLUMNS).issubset(columns):
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"The CSV header must contain the columns {CSV_COLUMNS}")
+                continue
+            record = dict(zip(columns, record))
+        try:
+            yield line_number, IngredientPreferenceCreate.model_validate(record), None
+        except (ValueError, ValidationError) as e:
+            yield line_number, None, f"Line {line_number}: {e}"
+
+
+async def _merge_batch(conn, raw_connection, batch, import_result):
+    # Start the transaction through SQLAlchemy, so that the COPY runs in it
+    await conn.execute(text(f"TRUNCATE {STAGING_TABLE}"))
+    await raw_connection.copy_records_to_table(STAGING_TABLE, records=batch, columns=["line", *CSV_COLUMNS])
+    enum_type = IngredientPreference.__table__.c.preference.type.name
+    counts = (await conn.execute(text(_MERGE_STAGING_TABLE.format(enum_type=enum_type)))).one()
+    await conn.commit()
+
+    import_result.inserted += counts.inserted
+    import_result.conflicts += counts.conflicts
+    import_result.duplicates += counts.staged - counts.distinct_rows
+    import_result.unchanged += counts.distinct_rows - counts.inserted - counts.conflicts
+    metrics.inc("preferences_imported_rows_total", counts.staged)
+
+
+async def _merge_batch_sqlite(conn, batch, import_result):
+    """Same merge as _merge_batch for the embedded SQLite mode, which has no COPY (nor network round trips to save)"""
+    rows = {}
+    for _, user_id, ingredient, preference in batch:
+        rows.setdefault((user_id, ingredient), preference)
+
+    keys = list(rows)
+    existing = {}
+    for i in range(0, len(keys), SQLITE_KEYS_PER_QUERY):
+        slct_ret = select(IngredientPreference.user_id, IngredientPreference.ingredient, IngredientPreference.preference).filter(
+            tuple_(IngredientPreference.user_id, IngredientPreference.ingredient).in_(keys[i:i + SQLITE_KEYS_PER_QUERY])
+        )
+        for row in await conn.execute(slct_ret):
+            existing[(row.user_id, row.ingredient)] = row.preference.value
+
+    new_rows = [{"user_id": user_id, "ingredient": ingredient, "preference": preference}
+                for (user_id, ingredient), preference in rows.items() if (user_id, ingredient) not in existing]
+    inserted_users = set()
+    if new_rows:
+        insert_stmt = sqlite.insert(IngredientPreference).on_conflict_do_nothing(index_elements=["user_id", "ingredient"])
+        inserted_users = set((await conn.execute(insert_stmt.returning(IngredientPreference.user_id), new_rows)).scalars())
+    if inserted_users:
+        bump_stmt = sqlite.insert(UserPreferencesVersion).on_conflict_do_update(
+            index_elements=[UserPreferencesVersion.user_id],
+            set_={"version": UserPreferencesVersion.version + 1}
+        )
+        await conn.execute(bump_stmt, [{"user_id": user_id, "version": 1} for user_id in inserted_users])
+    await conn.commit()
+    for user_id in inserted_users:
+        preferences_cache.evict_user(user_id)
+
+    conflicts = sum(1 for key, preference in rows.items() if key in existing and existing[key] != preference)
+    import_result.inserted += len(new_rows)
+    import_result.conflicts += conflicts
+    import_result.duplicates += len(batch) - len(rows)
+    import_result.unchanged += len(rows) - len(new_rows) - conflicts
+    metrics.inc("preferences_imported_rows_total", len(batch))
+
+
+async def _open_merger(stack, engine, import_result):
+    """Opens a connection (kept for the whole import) to a shard and returns the function merging a batch into it"""
+    conn = await stack.enter_async_context(engine.connect())
+    if conn.dialect.name == "sqlite":
+        return lambda batch: _merge_batch_sqlite(conn, batch, import_result)
+    await conn.execute(text(_CREATE_STAGING_TABLE))
+    raw_connection = (await conn.get_raw_connection()).driver_connection
+    return lambda batch: _merge_batch(conn, raw_connection, batch, import_result)
+
+
+async def import_preferences(shards: ShardedDatabase, byte_chunks, bulk_format: BulkFormat):
+    """Imports the preferences of an NDJSON/CSV stream, parsing it incrementally and loading it in batches through COPY into a
+    staging table that is then merged into ingredient_preferences (in the embedded SQLite mode, the batches are merged directly). Every batch is committed on its own, and merging is idempotent,
+    so a failed import can be safely retried. The rows are batched per shard, and only the shards holding some of them are connected to.
+
+    Args:
+        shards (ShardedDatabase): shards of the database
+        byte_chunks (AsyncIterator[bytes]): request body stream
+        bulk_format (BulkFormat): format of the stream
+
+    Returns:
+        IngredientPreferencesImportResult: row counts of the import
+    """
+    import_result = IngredientPreferencesImportResult()
+    async with AsyncExitStack() as stack:
+        mergers = {}
+        batches = {}
+
+        async def merge_batch(shard):
+            if shard not in mergers:
+                mergers[shard] = await _open_merger(stack, shards.engines[shard], import_result)
+            await mergers[shard](batches.pop(shard))
+
+        async for line_number, preference, error in _parse_preferences(byte_chunks, bulk_format):
+            import_result.received += 1
+            if error is not None:
+                import_result.invalid += 1
+                if len(import_result.errors) < MAX_REPORTED_ERRORS:
+                    import_result.errors.append(error)
+                continue
+            shard = shards.shard_for(preference.user_id)
+            batch = batches.setdefault(shard, [])
+            batch.append((line_number, preference.user_id, preference.ingredient, preference.preference.value))
+            if len(batch) >= BULK_BATCH_SIZE:
+                await merge_batch(shard)
+                logger.info("Preferences import in progress: %d rows received, %d inserted", import_result.received, import_result.inserted)
+        for shard in list(batches):
+            await merge_batch(shard)
+
+    logger.info("Preferences import finished: %s", import_result.model_dump(exclude={"errors"}))
+
+    return import_result
+
+
+async def export_preferences(shards: ShardedDatabase, bulk_format: BulkFormat, user_id: int = None):
+    """Streams the preferences (of a single user, or of all of them) as NDJSON/CSV, reading them with a server-side cursor. All the
+    users are exported one shard after the other (so the rows are only sorted by user within each shard)
+
+    Args:
+        shards (ShardedDatabase): shards of the database
+        bulk_format (BulkFormat): format of the stream
+        user_id (int, optional): user whose preferences are exported. Defaults to None (all the users).
+
+    Yields:
+        str: chunks of the export, each one holding up to BULK_BATCH_SIZE rows
+    """
+    slct_ret = select(
+        IngredientPreference.user_id, IngredientPreference.ingredient, IngredientPreference.preference
+    ).order_by(IngredientPreference.user_id, IngredientPreference.ingredient)
+    if user_id is not None:
+        slct_ret = slct_ret.filter(IngredientPreference.user_id == user_id)
+
+    engines = [shards.engine_for(user_id)] if user_id is not None else list(shards.engines.values())
+    exported_rows = 0
+    if bulk_format == BulkFormat.csv:
+        yield ",".join(CSV_COLUMNS) + "\r\n"
+    for engine in engines:
+        async with engine.connect() as conn:
+            result = await conn.stream(slct_ret.execution_options(yield_per=BULK_BATCH_SIZE))
+            async for partition in result.partitions():
+                chunk = io.StringIO()
+                if bulk_format == BulkFormat.csv:
+                    writer = csv.writer(chunk)
+                    writer.writerows((row.user_id, row.ingredient, row.preference.value) for row in partition)
+                else:
+                    for row in partition:
+                        chunk.write(json.dumps({"user_id": row.user_id, "ingredient": row.ingredient, "preference": row.preference.value}) + "\n")
+                exported_rows += len(partition)
+                metrics.inc("preferences_exported_rows_total", len(partition))
+                logger.info("Preferences export in progress: %d rows exported", exported_rows)
+                yield chunk.getvalue()
+
+    logger.info("Preferences export finished: %d rows exported", exported_rows)
@@ -1,8 +1,32 @@
 from fastapi import HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.future import select
-from app.models.models_ingredients import IngredientPreference
+from app.database import invalidation
+from app.models.models_ingredients import IngredientPreference, UserPreferencesVersion
 from app.schemas.schema_ingredients import IngredientPreferenceCreate, IngredientPreferenceUpdate
+from app.utils.cache import preferences_cache
+
+async def get_preferences_version(db: AsyncSession, user_id: int):
+    slct_ret = select(UserPreferencesVersion.version).filter(
+        UserPreferencesVersion.user_id == user_id
+    )
+    result = await db.execute(slct_ret)
+
+    return result.scalar_one_or_none() or 0
+
+def dialect_insert(db: AsyncSession):
+    """Returns the INSERT construct (supporting ON CONFLICT upserts) of the dialect of the session, PostgreSQL or SQLite"""
+    return sqlite.insert if db.bind.dialect.name == "sqlite" else postgresql.insert
+
+async def _bump_preferences_version(db: AsyncSession, user_id: int):
+    # Executed in the same transaction as the write it versions, as is the invalidation of the caches of the other workers
+    upsert_stmt = dialect_insert(db)(UserPreferencesVersion).values(user_id=user_id, version=1).on_conflict_do_update(
+        index_elements=[UserPreferencesVersion.user_id],
+        set_={"version": UserPreferencesVersion.version + 1}
+    ).returning(UserPreferencesVersion.version)
+    version = (await db.execute(upsert_stmt)).scalar_one()
+    await invalidation.publish(db, user_id, version)
 
 async def get_ingredient(db: AsyncSession, user_id: int, ingredient_name: str):
     slct_ret = select(IngredientPreference).filter(
@@ -27,7 +51,10 @@ async def create_ingredient(db: AsyncSession, igredient_data: IngredientPreferen
         preference=igredient_data.preference        
     )
     db.add(new_preference)
+    await _bump_preferences_version(db, igredient_data.user_id)
     await db.commit()
+    # The own invalidation of this worker arrives a few milliseconds later
+    preferences_cache.evict_user(igredient_data.user_id)
     await db.refresh(new_preference)
 
     return new_preference
@@ -41,7 +68,9 @@ async def update_ingredient(db: AsyncSession, user_id: int, igredient_name: str,
         )
 
     preference.preference = update_data.preference
+    await _bump_preferences_version(db, user_id)
     await db.commit()
+    preferences_cache.evict_user(user_id)
     await db.refresh(preference)
 
     return preference
@@ -55,7 +84,9 @@ async def delete_ingredient(db: AsyncSession, user_id: int, igredient_name: str)
     preference = result.scalar_one_or_none()
     if preference:
         await db.delete(preference)
+        await _bump_preferences_version(db, user_id)
         await db.commit()
+        preferences_cache.evict_user(user_id)
         
         return preference
     else:
@@ -1,17 +1,54 @@
 from dotenv import load_dotenv
 import os
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import DeclarativeBase
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Connection pool of each worker process (the production launcher sizes it from the total connection budget, see app/server.py)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_ECHO = os.getenv("DB_ECHO", "true").lower() == "true"
 
-async_engine = create_async_engine(DATABASE_URL, echo=True)
-AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False,  class_=AsyncSession)
+# Pragmas of the embedded SQLite (sqlite+aiosqlite) mode: WAL lets readers run concurrently with the (single) writer, and a
+# NORMAL synchronous level is durable in WAL mode except for the last transactions on power loss
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",
+    "busy_timeout": "5000",
+    "cache_size": "-65536",
+    "temp_store": "MEMORY",
+    "mmap_size": "268435456",
+}
+
+def is_sqlite(url):
+    return make_url(url).get_backend_name() == "sqlite"
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+def create_engine_for(url, echo=DB_ECHO, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW):
+    """Creates the async engine of a database URL, either an external PostgreSQL (postgresql+asyncpg) or an embedded SQLite
+    (sqlite+aiosqlite) database"""
+    if is_sqlite(url):
+        database = make_url(url).database
+        if not database or database == ":memory:":
+            # In-memory databases live in a single connection (static pool)
+            engine = create_async_engine(url, echo=echo)
+        else:
+            engine = create_async_engine(url, echo=echo, pool_size=pool_size, max_overflow=max_overflow)
+        event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+        return engine
+
+    return create_async_engine(url, echo=echo, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
+
+async_engine = create_engine_for(DATABASE_URL)
 
 class Base(DeclarativeBase):
     pass
-
-async def get_db():
-    async with AsyncSessionLocal() as session:
-        yield session
\ No newline at end of file
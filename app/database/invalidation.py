@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import asyncpg
+from dotenv import load_dotenv
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database.sharding import ShardedDatabase, shards
+from app.utils.cache import UserCache, preferences_cache
+from app.utils.metrics import registry as metrics
+
+load_dotenv()
+# Seconds between the checks of the listener connections (a half-open connection would silently stop receiving the invalidations)
+INVALIDATION_HEALTHCHECK_INTERVAL = float(os.getenv("INVALIDATION_HEALTHCHECK_INTERVAL", "10"))
+INVALIDATION_MAX_RECONNECT_DELAY = 5.0
+
+INVALIDATION_CHANNEL = "preferences_changed"
+# Payload of the notifications invalidating all the users
+FLUSH_ALL = "*"
+
+logger = logging.getLogger("invalidation")
+
+
+async def publish(db: AsyncSession, user_id: int, version: int):
+    """Publishes the new version of the preferences of a user to all the workers. The notification is part of the transaction of the
+    write: it is only delivered if (and when) the transaction commits. Only PostgreSQL databases have an invalidation bus."""
+    if db.bind.dialect.name == "postgresql":
+        await db.execute(select(func.pg_notify(INVALIDATION_CHANNEL, f"{user_id}:{version}")))
+
+
+async def publish_flush(db: AsyncSession):
+    """Publishes the invalidation of all the users to all the workers (see publish)"""
+    if db.bind.dialect.name == "postgresql":
+        await db.execute(select(func.pg_notify(INVALIDATION_CHANNEL, FLUSH_ALL)))
+
+
+class InvalidationListener:
+    """Keeps a LISTEN connection to each shard (PostgreSQL only), evicting the cached data of the users written by any worker.
+
+    The cache is only enabled while all the shards are being listened to: when a connection drops, the cache is disabled and
+    flushed (the invalidations sent in the meantime are lost) until it is reconnected.
+    """
+    def __init__(self, database: ShardedDatabase, cache: UserCache) -> None:
+        self.database = database
+        self.cache = cache
+        self._connected = set()
+        self._tasks = []
+
+    def _on_notification(self, connection, pid, channel, payload):
+        metrics.inc("invalidation_events_total")
+        if payload == FLUSH_ALL:
+            self.cache.clear()
+            return
+        user_id, _, _ = payload.partition(":")
+        try:
+            self.cache.evict_user(int(user_id))
+        except ValueError:
+            logger.error(f"Invalid invalidation event: {payload}")
+            self.cache.clear()
+
+    def _set_connected(self, shard, connected):
+        if connected:
+            self._connected.add(shard)
+        else:
+            self._connected.discard(shard)
+        # Anything may have changed while (any shard was) not listened to
+        self.cache.clear()
+        self.cache.enabled = len(self._connected) == len(self.database.engines)
+        metrics.set_gauge("invalidation_listeners_connected", len(self._connected))
+
+    async def _listen(self, shard, dsn):
+        reconnect_delay = 0.1
+        while True:
+            try:
+                connection = await asyncpg.connect(dsn)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError, asyncio.TimeoutError) as e:
+                logger.warning(f"Could not connect the invalidation listener of shard {shard}, retrying in {reconnect_delay:.1f}s: {e}")
+                await asyncio.sleep(reconnect_delay)
+                reconnect_delay = min(INVALIDATION_MAX_RECONNECT_DELAY, reconnect_delay * 2)
+                continue
+
+            reconnect_delay = 0.1
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            try:
+                await connection.add_listener(INVALIDATION_CHANNEL, self._on_notification)
+                self._set_connected(shard, True)
+                logger.info(f"Listening to the invalidations of shard {shard}")
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), INVALIDATION_HEALTHCHECK_INTERVAL)
+                    except asyncio.TimeoutError:
+                        await asyncio.wait_for(connection.execute("SELECT 1"), INVALIDATION_HEALTHCHECK_INTERVAL)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError, asyncio.TimeoutError) as e:
+                logger.warning(f"Invalidation listener of shard {shard} failed: {e}")
+            finally:
+                if shard in self._connected:
+                    self._set_connected(shard, False)
+                connection.terminate()
+            logger.warning(f"Invalidation listener of shard {shard} disconnected, reconnecting")
+            metrics.inc("invalidation_listener_reconnects_total", shard=shard)
+
+    async def start(self):
+        """Starts listening to the invalidations of the PostgreSQL shards (the cache stays disabled for the rest of databases)"""
+        for shard, engine in self.database.engines.items():
+            if engine.dialect.name != "postgresql":
+                logger.info(f"Shard {shard} has no invalidation bus: preferences cache disabled")
+                continue
+            dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+            self._tasks.append(asyncio.create_task(self._listen(shard, dsn)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.cache.enabled = False
+        self.cache.clear()
+
+
+invalidation_listener = InvalidationListener(shards, preferences_cache)
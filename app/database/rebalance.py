@@ -0,0 +1,139 @@
+"""Rebalancing of the user data when adding (or removing) shards.
+
+    python -m app.database.rebalance --to "shard0=postgresql+asyncpg://...,shard1=postgresql+asyncpg://..." [--dry-run]
+
+Every user found in the current shards (DATABASE_SHARD_URLS, or DATABASE_URL) or in the new ones whose shard changes with the new
+list is moved to its new shard: its preferences and version are copied (replacing any leftover of a previous run) and then deleted
+from the old shard. Shards keep their names, so the new list must keep the names (or positions) of the current ones. Thanks to the
+consistent hashing, adding a shard only moves about 1/N of the users.
+
+Writes must be paused while the users are moved (the writes of a user received between its copy and its deletion would be lost).
+Moving is idempotent, so an interrupted rebalance can simply be run again. Then deploy the new DATABASE_SHARD_URLS.
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from sqlalchemy import delete, insert, inspect, union
+from sqlalchemy.engine import make_url
+from sqlalchemy.future import select
+from app.database.sharding import ConsistentHashRing, ShardedDatabase, parse_shard_urls, shards as current_shards
+from app.database.database import create_engine_for
+from app.models.models_ingredients import IngredientPreference, UserPreferencesVersion
+
+# Users moved per transaction
+REBALANCE_USERS_PER_BATCH = 500
+
+
+async def _list_users(engine):
+    users_select = union(select(IngredientPreference.user_id), select(UserPreferencesVersion.user_id))
+    async with engine.connect() as conn:
+        # New shards have no tables yet in dry runs
+        if not await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table(UserPreferencesVersion.__tablename__)):
+            return []
+        return (await conn.execute(users_select)).scalars().all()
+
+
+async def plan_moves(database: ShardedDatabase, ring: ConsistentHashRing):
+    """Finds the users that are not in their shard of the given ring
+
+    Returns:
+        dict: (current shard, new shard) -> list of user IDs
+    """
+    moves = defaultdict(list)
+    for shard, engine in database.engines.items():
+        for user_id in await _list_users(engine):
+            target = ring.shard_for(user_id)
+            if target != shard:
+                moves[(shard, target)].append(user_id)
+    return moves
+
+
+async def move_users(source_engine, target_engine, user_ids):
+    """Moves the preferences and versions of some users from a shard to another one
+
+    Returns:
+        int: number of preferences moved
+    """
+    async with source_engine.connect() as source:
+        preferences = (await source.execute(
+            select(IngredientPreference.user_id, IngredientPreference.ingredient, IngredientPreference.preference)
+            .filter(IngredientPreference.user_id.in_(user_ids))
+        )).mappings().all()
+        versions = dict((await source.execute(
+            select(UserPreferencesVersion.user_id, UserPreferencesVersion.version).filter(UserPreferencesVersion.user_id.in_(user_ids))
+        )).all())
+
+    async with target_engine.begin() as target:
+        # A user may already have been in the new shard (e.g. a previous run interrupted, or a shard removed and added back): its new
+        # version is bumped past both of them, so that no ETag is ever reused for different preferences
+        target_versions = dict((await target.execute(
+            select(UserPreferencesVersion.user_id, UserPreferencesVersion.version).filter(UserPreferencesVersion.user_id.in_(user_ids))
+        )).all())
+        await target.execute(delete(IngredientPreference).filter(IngredientPreference.user_id.in_(user_ids)))
+        await target.execute(delete(UserPreferencesVersion).filter(UserPreferencesVersion.user_id.in_(user_ids)))
+        if preferences:
+            await target.execute(insert(IngredientPreference), [dict(preference) for preference in preferences])
+        await target.execute(insert(UserPreferencesVersion), [
+            {"user_id": user_id, "version": max(versions.get(user_id, 0), target_versions.get(user_id, 0)) + 1} for user_id in user_ids
+        ])
+
+    async with source_engine.begin() as source:
+        await source.execute(delete(IngredientPreference).filter(IngredientPreference.user_id.in_(user_ids)))
+        await source.execute(delete(UserPreferencesVersion).filter(UserPreferencesVersion.user_id.in_(user_ids)))
+
+    return len(preferences)
+
+
+async def rebalance(database: ShardedDatabase, ring: ConsistentHashRing, dry_run = False):
+    """Moves every user of the shards of the database that is not in its shard of the given ring
+
+    Args:
+        database (ShardedDatabase): all the shards, current and new ones
+        ring (ConsistentHashRing): ring of the new shards
+        dry_run (bool, optional): only report the moves. Defaults to False.
+
+    Returns:
+        dict: (current shard, new shard) -> (users moved, preferences moved)
+    """
+    moves = await plan_moves(database, ring)
+    report = {}
+    for (source, target), user_ids in moves.items():
+        moved_preferences = 0
+        if not dry_run:
+            for i in range(0, len(user_ids), REBALANCE_USERS_PER_BATCH):
+                moved_preferences += await move_users(
+                    database.engines[source], database.engines[target], user_ids[i:i + REBALANCE_USERS_PER_BATCH]
+                )
+        report[(source, target)] = (len(user_ids), moved_preferences)
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", required=True, help="new comma-separated shard URLs (optionally named, name=url)")
+    parser.add_argument("--dry-run", action="store_true", help="only report the users that would be moved")
+    args = parser.parse_args()
+
+    new_shard_urls = parse_shard_urls(args.to)
+    engines = dict(current_shards.engines)
+    for name, url in new_shard_urls.items():
+        if name in engines:
+            if engines[name].url != make_url(url):
+                raise SystemExit(f"Shard {name} has a different URL in the new list: shards cannot be renamed")
+        else:
+            engines[name] = create_engine_for(url, echo=False)
+    database = ShardedDatabase(engines)
+    try:
+        if not args.dry_run:
+            await database.create_all()
+        report = await rebalance(database, ConsistentHashRing(list(new_shard_urls)), args.dry_run)
+        for (source, target), (users, preferences) in sorted(report.items()):
+            print(f"{source} -> {target}: {users} users" + ("" if args.dry_run else f", {preferences} preferences moved"))
+        if not report:
+            print("Every user is already in its shard")
+    finally:
+        await database.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import bisect
+import hashlib
+import os
+import re
+from dotenv import load_dotenv
+from fastapi import Query
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from app.database.database import async_engine, create_engine_for, Base
+
+load_dotenv()
+# Comma-separated URLs of the shards, optionally named (name=url). Unnamed shards are named after their position (shard0, shard1...),
+# so new shards must be appended. Empty to use DATABASE_URL as the only shard
+DATABASE_SHARD_URLS = os.getenv("DATABASE_SHARD_URLS", "")
+# Points of each shard in the hash ring: more points spread the users more evenly
+SHARD_VIRTUAL_NODES = int(os.getenv("SHARD_VIRTUAL_NODES", "128"))
+DEFAULT_SHARD = "shard0"
+
+_NAMED_SHARD_PATTERN = re.compile(r"^(\w+)=(.+)$")
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def parse_shard_urls(value):
+    """Parses a comma-separated list of shard URLs (optionally named, name=url)
+
+    Returns:
+        dict: shard name -> database URL, in order
+    """
+    shard_urls = {}
+    for position, item in enumerate(part.strip() for part in value.split(",") if part.strip()):
+        match = _NAMED_SHARD_PATTERN.match(item)
+        name, url = match.groups() if match else (f"shard{position}", item)
+        if name in shard_urls:
+            raise ValueError(f"Duplicated shard name: {name}")
+        shard_urls[name] = url
+    return shard_urls
+
+
+class ConsistentHashRing:
+    """Consistent hashing of the user IDs to the shards: adding a shard only moves the users of its new ring segments (about 1/N of
+    them), instead of almost all of them as with a modulo"""
+    def __init__(self, shards, virtual_nodes = SHARD_VIRTUAL_NODES) -> None:
+        if not shards:
+            raise ValueError("At least one shard is required")
+        points = sorted((_hash(f"{shard}#{node}"), shard) for shard in shards for node in range(virtual_nodes))
+        self._positions = [position for position, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, user_id):
+        index = bisect.bisect(self._positions, _hash(str(user_id))) % len(self._positions)
+        return self._shards[index]
+
+
+class ShardedDatabase:
+    """Engines of the shards of the user data (ingredient preferences and their versions), all of them keyed by user_id"""
+    def __init__(self, engines, virtual_nodes = SHARD_VIRTUAL_NODES) -> None:
+        self.engines = dict(engines)
+        self.ring = ConsistentHashRing(list(self.engines), virtual_nodes)
+        self._session_factories = {
+            name: async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession) for name, engine in self.engines.items()
+        }
+
+    @classmethod
+    def from_urls(cls, shard_urls, virtual_nodes = SHARD_VIRTUAL_NODES, **engine_kwargs):
+        return cls({name: create_engine_for(url, **engine_kwargs) for name, url in shard_urls.items()}, virtual_nodes)
+
+    def shard_for(self, user_id) -> str:
+        return self.ring.shard_for(user_id)
+
+    def engine_for(self, user_id) -> AsyncEngine:
+        return self.engines[self.shard_for(user_id)]
+
+    def session(self, user_id = None, shard = None) -> AsyncSession:
+        """Opens a session on the shard of a user (or on the given shard)"""
+        return self._session_factories[shard or self.shard_for(user_id)]()
+
+    async def create_all(self):
+        for engine in self.engines.values():
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+
+    async def dispose(self):
+        for engine in self.engines.values():
+            await engine.dispose()
+
+
+if DATABASE_SHARD_URLS.strip():
+    shards = ShardedDatabase.from_urls(parse_shard_urls(DATABASE_SHARD_URLS))
+else:
+    # Single database: the default engine is the only shard
+    shards = ShardedDatabase({DEFAULT_SHARD: async_engine})
+
+
+async def get_user_db(user_id: int = Query(..., gt=0)):
+    """Dependency providing a session on the shard of the user of the request"""
+    async with shards.session(user_id) as session:
+        yield session
@@ -1,50 +1,90 @@
 from contextlib import asynccontextmanager
 import logging
 import traceback
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.responses import JSONResponse
 import uvicorn
 from app.api import endpoints_ingredients, endpoints_recipes, endpoints_admin
-from app.database.database import async_engine, Base
+from app.crud.group_commit import close_writers
+from app.database.invalidation import invalidation_listener
+from app.database.sharding import shards
+from app.utils import profiling
 
 # Configure basic logging
 logging.basicConfig(level=logging.INFO)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Create database tables if needed
-    async with async_engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Create database tables (in every shard) if needed
+    await shards.create_all()
+    # Evict the cached data written by the other workers
+    await invalidation_listener.start()
     yield
-    # Close async engine
-    await async_engine.dispose()
+    # The in-flight requests (and thus their LLM generations) were drained by the server (see app/server.py)
+    # Commit the pending group-committed writes
+    await close_writers()
+    await invalidation_listener.stop()
+    # Close the async engines of the shards
+    await shards.dispose()
 
 app = FastAPI(title="Recipe Service", 
               description="A backend service for managing ingredient preferences and creating delicious recipes.",
               version="1.0.0",
               lifespan=lifespan)
 
-@app.middleware("http")
-async def catch_exceptions_middleware(request: Request, call_next):
-    try:
-        return await call_next(request)
-    except HTTPException as http_exc:
-        # Preserve HTTPException responses
-        return JSONResponse(
-            status_code=http_exc.status_code,
-            content={"detail": http_exc.detail},
-        )
-    except Exception as e:
-        # Log and return a generic 500 response for unhandled errors
-        logging.error(f"Unhandled error: {e}")
-        traceback.print_exc()
-        return JSONResponse(
-            status_code=500,
-            content={"detail": "Internal Server Error. Please try again later."}
-        )
-    
+class CatchExceptionsMiddleware:
+    """Returns a JSON error response for the exceptions not handled by the app.
+
+    It is a pure ASGI middleware: a @app.middleware("http") one (BaseHTTPMiddleware) wraps the ASGI receive channel, and behind
+    it Request.is_disconnected() never sees the client disconnections (so the LLM generations of gone clients are never aborted).
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+            return
+        except HTTPException as http_exc:
+            if response_started:
+                raise
+            # Preserve HTTPException responses
+            response = JSONResponse(
+                status_code=http_exc.status_code,
+                content={"detail": http_exc.detail},
+            )
+        except Exception as e:
+            # Log and return a generic 500 response for unhandled errors
+            logging.error(f"Unhandled error: {e}")
+            traceback.print_exc()
+            if response_started:
+                raise
+            response = JSONResponse(
+                status_code=500,
+                content={"detail": "Internal Server Error. Please try again later."}
+            )
+        await response(scope, receive, send)
+
+app.add_middleware(CatchExceptionsMiddleware)
+
+# Opt-in request profiling (not installed at all when disabled)
+if profiling.profiling_available():
+    app.add_middleware(profiling.ProfileRequestsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  
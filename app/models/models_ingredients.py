@@ -16,4 +16,11 @@ class IngredientPreference(Base):
 
     __table_args__ = (
         UniqueConstraint("user_id", "ingredient", name="uix_user_ingredient"), # Unique combination of user-ingredient preference constraint
-    )
\ No newline at end of file
+    )
+
+class UserPreferencesVersion(Base):
+    """Version of the preferences of each user, incremented by every write (used for the ETags of the preferences reads)"""
+    __tablename__ = "user_preferences_versions"
+
+    user_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
@@ -26,4 +26,19 @@ class IngredientPreferenceOut(IngredientPreferenceBase):
     model_config = {
         "from_attributes": True,  # for Pydantic v2 compatibility
         # "orm_mode": True
-    }
\ No newline at end of file
+    }
+
+# Formats of the bulk import/export of preferences
+class BulkFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+# Model for the bulk import summaries
+class IngredientPreferencesImportResult(BaseModel):
+    received: int = 0
+    inserted: int = 0
+    unchanged: int = 0
+    conflicts: int = 0
+    duplicates: int = 0
+    invalid: int = 0
+    errors: list[str] = []
@@ -1,10 +1,33 @@
-from pydantic import BaseModel, Field, RootModel
+import re
+from enum import Enum
+from pydantic import BaseModel, Field, RootModel, field_validator, model_validator
 from typing import List
 
+# Common deviations of the LLM structured output are coerced before validating (they don't change the JSON schema sent to the LLM)
+def _number_to_str(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
 class Ingredient(BaseModel):
     ingredient: str = Field(..., description="The name of the ingredient.")
     quantity: str = Field(..., description="The quantity of the ingredient.")
 
+    @model_validator(mode="before")
+    @classmethod
+    def _coerce_ingredient_key(cls, data):
+        # e.g. {"name": "tomato", ...} or {"ingredient1": "tomato", ...} instead of {"ingredient": "tomato", ...}
+        if isinstance(data, dict) and "ingredient" not in data:
+            key = next((k for k in data if k == "name" or k.startswith("ingredient")), None)
+            if key is not None:
+                data = {**data, "ingredient": data[key]}
+        return data
+
+    @field_validator("quantity", mode="before")
+    @classmethod
+    def _coerce_quantity(cls, value):
+        return _number_to_str(value)
+
 class Recipe(BaseModel):
     name: str = Field(..., description="The title of the recipe.")
     ingredients_quantities: List[Ingredient] = Field(
@@ -20,5 +43,45 @@ class Recipe(BaseModel):
     calories: str = Field(..., description="Calories per serving.")
     servings: int = Field(..., description="Number of servings.")
 
+    @field_validator("estimated_cooking_time", "calories", mode="before")
+    @classmethod
+    def _coerce_numbers(cls, value):
+        return _number_to_str(value)
+
+    @field_validator("instructions", mode="before")
+    @classmethod
+    def _coerce_instructions(cls, value):
+        # A list of steps instead of a single text
+        if isinstance(value, list) and all(isinstance(step, str) for step in value):
+            return "\n".join(value)
+        return value
+
+    @field_validator("servings", mode="before")
+    @classmethod
+    def _coerce_servings(cls, value):
+        # e.g. 4.0, "4", "4 servings" or "2-3" (the lower bound is kept)
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, str):
+            match = re.search(r"\d+", value)
+            if match:
+                return int(match.group())
+        return value
+
 class RecipeList(RootModel[List[Recipe]]):
-    pass
\ No newline at end of file
+    pass
+
+class RecipePlan(BaseModel):
+    titles: List[str] = Field(..., description="Titles of clearly different recipes.")
+
+class RecipesGenerationMode(str, Enum):
+    # All the recipes in a single LLM call
+    single = "single"
+    # A short planning call, then one concurrent LLM call per recipe
+    parallel = "parallel"
+
+class RecipesPlanning(str, Enum):
+    # A short LLM call choosing distinct recipe titles
+    llm = "llm"
+    # A fixed diversity scheme (no LLM call)
+    fixed = "fixed"
@@ -0,0 +1,134 @@
+"""Production server entry point.
+
+Runs the service with N worker processes:
+
+    python -m app.server
+
+When gunicorn is installed, the app is imported once in the master process (preload) and forked into uvicorn workers.
+Otherwise uvicorn's own process manager is used. uvloop and httptools are used when available.
+"""
+import importlib.util
+import logging
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+# Number of worker processes. Defaults to the number of cores
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# Total number of DB connections the service may open, split between the workers
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "40"))
+# Connections each worker keeps outside of its pool: the LISTEN connection of the cache invalidations (see app/database/invalidation.py)
+LISTENER_CONNECTIONS_PER_WORKER = 1
+# Seconds the in-flight requests (and their LLM generations) are given to finish when shutting down
+GRACEFUL_SHUTDOWN_TIMEOUT = float(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "30"))
+# Seconds left for the rest of the lifespan shutdown (pending group commits, engine disposal)
+SHUTDOWN_MARGIN = 5
+
+logger = logging.getLogger("server")
+
+
+def configure_db_pool(workers, connection_budget):
+    """Sizes the DB connection pool of each worker so that all of them together, with their LISTEN connections, never exceed the
+    connection budget. It must be called before the app (and thus the database engine) is imported.
+
+    Args:
+        workers (int): number of worker processes
+        connection_budget (int): total number of DB connections
+
+    Returns:
+        int: pool size of each worker
+    """
+    pool_size = max(1, connection_budget // workers - LISTENER_CONNECTIONS_PER_WORKER)
+    os.environ.setdefault("DB_POOL_SIZE", str(pool_size))
+    os.environ.setdefault("DB_MAX_OVERFLOW", "0")
+    os.environ.setdefault("DB_ECHO", "false")
+
+    return int(os.environ["DB_POOL_SIZE"])
+
+
+def worker_shutdown_timeout(graceful_shutdown_timeout):
+    """Max seconds a worker may take to shut down before being killed: the in-flight requests are drained for up to
+    graceful_shutdown_timeout (uvicorn's timeout_graceful_shutdown, after which their LLM generations are cancelled with them),
+    then the lifespan shutdown runs
+
+    Returns:
+        int: worker shutdown timeout (gunicorn's graceful_timeout)
+    """
+    return int(graceful_shutdown_timeout) + SHUTDOWN_MARGIN
+
+
+def event_loop_implementation():
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+
+def http_implementation():
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+def _run_gunicorn(workers):
+    from gunicorn.app.base import BaseApplication
+    from uvicorn.workers import UvicornWorker
+
+    class _DrainingUvicornWorker(UvicornWorker):
+        # The uvicorn worker picks uvloop/httptools automatically when they are installed. On shutdown it stops accepting
+        # connections and waits for the in-flight requests before running the lifespan shutdown
+        CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "timeout_graceful_shutdown": GRACEFUL_SHUTDOWN_TIMEOUT}
+
+    class _GunicornApplication(BaseApplication):
+        def __init__(self, options) -> None:
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app.main import app
+            return app
+
+    _GunicornApplication({
+        "bind": f"{HOST}:{PORT}",
+        "workers": workers,
+        "worker_class": _DrainingUvicornWorker,
+        "preload_app": True,
+        # Leave some margin for the lifespan shutdown after the requests are drained
+        "graceful_timeout": worker_shutdown_timeout(GRACEFUL_SHUTDOWN_TIMEOUT),
+        # LLM generations can take up to the LLM client timeout
+        "timeout": 180,
+    }).run()
+
+
+def _run_uvicorn(workers):
+    import uvicorn
+
+    # Import the app once in this process to fail fast on configuration errors before spawning the workers
+    import app.main  # noqa: F401
+    uvicorn.run(
+        "app.main:app",
+        host=HOST,
+        port=PORT,
+        workers=workers,
+        loop=event_loop_implementation(),
+        http=http_implementation(),
+        timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT,
+    )
+
+
+def run():
+    logging.basicConfig(level=logging.INFO)
+    workers = max(1, WEB_CONCURRENCY)
+    pool_size = configure_db_pool(workers, DB_CONNECTION_BUDGET)
+    logger.info("Starting %d workers (DB pool of %d connections each, event loop: %s, http: %s)",
+                workers, pool_size, event_loop_implementation(), http_implementation())
+
+    if importlib.util.find_spec("gunicorn"):
+        _run_gunicorn(workers)
+    else:
+        _run_uvicorn(workers)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,107 @@
+import logging
+import math
+import os
+import time
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from app.utils.metrics import registry as metrics
+
+load_dotenv()
+ADMISSION_INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", "32"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "2"))
+ADMISSION_MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "256"))
+# Latency (in seconds) the admitted requests must stay within. It must be well below the 120 s client timeout
+ADMISSION_LATENCY_TARGET = float(os.getenv("ADMISSION_LATENCY_TARGET", "30"))
+ADMISSION_BACKOFF_RATIO = float(os.getenv("ADMISSION_BACKOFF_RATIO", "0.9"))
+
+logger = logging.getLogger("admission")
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit of the requests admitted at the same time.
+
+    The limit grows additively (by one every limit's worth of requests completed within the latency target while the limit was
+    being used) and shrinks multiplicatively whenever a request is slower than the target or fails because of an overload. Requests
+    beyond the limit are rejected right away, so that the admitted ones still finish within the target instead of all of them
+    timing out together when the LLM backend slows down.
+    """
+    def __init__(self, initial_limit, min_limit, max_limit, latency_target, backoff_ratio = 0.9) -> None:
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self._average_latency = None
+
+    def try_acquire(self):
+        """Admits a request if the limit allows it
+
+        Returns:
+            bool: whether the request was admitted
+        """
+        if self.in_flight >= int(self.limit):
+            metrics.inc("admission_rejected_total")
+            return False
+        self.in_flight += 1
+        metrics.set_gauge("admission_in_flight", self.in_flight)
+        return True
+
+    def release(self, latency = None, overloaded = False):
+        """Releases an admitted request, adapting the limit to its outcome
+
+        Args:
+            latency (float, optional): latency of the request in seconds. None if it must not be taken into account (e.g. the client
+                disconnected). Defaults to None.
+            overloaded (bool, optional): whether the request failed because of an overload (timeouts, upstream errors...). Defaults to False.
+        """
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if latency is not None:
+            self._average_latency = latency if self._average_latency is None else 0.8 * self._average_latency + 0.2 * latency
+
+        if overloaded or (latency is not None and latency > self.latency_target):
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        elif latency is not None and in_flight * 2 >= self.limit:
+            # Only grow the limit when it is actually being used
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+        metrics.set_gauge("admission_in_flight", self.in_flight)
+        metrics.set_gauge("admission_limit", self.limit)
+
+    def retry_after(self):
+        """Seconds a rejected client should wait before retrying: about the time the admitted requests take to complete"""
+        estimate = self._average_latency if self._average_latency is not None else self.latency_target
+        return max(1, min(60, math.ceil(estimate)))
+
+
+recipes_limiter = AdaptiveConcurrencyLimiter(
+    ADMISSION_INITIAL_LIMIT, ADMISSION_MIN_LIMIT, ADMISSION_MAX_LIMIT, ADMISSION_LATENCY_TARGET, ADMISSION_BACKOFF_RATIO
+)
+
+
+async def admit_recipes_request():
+    """Dependency applying the admission control of the recipes path: it fails fast with a 503 (and Retry-After) when the service
+    is overloaded"""
+    if not recipes_limiter.try_acquire():
+        retry_after = recipes_limiter.retry_after()
+        logger.warning(f"Recipes request rejected: {recipes_limiter.in_flight} requests in flight (limit {int(recipes_limiter.limit)})")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The service is overloaded. Please try again later.",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    start = time.perf_counter()
+    try:
+        yield
+    except HTTPException as http_exc:
+        # Client errors are valid samples, a closed client connection is not
+        latency = None if http_exc.status_code == 499 else time.perf_counter() - start
+        recipes_limiter.release(latency, overloaded=http_exc.status_code >= 500)
+        raise
+    except Exception:
+        recipes_limiter.release(time.perf_counter() - start, overloaded=True)
+        raise
+    else:
+        recipes_limiter.release(time.perf_counter() - start)
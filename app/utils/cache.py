@@ -0,0 +1,88 @@
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from app.utils.metrics import registry as metrics
+
+load_dotenv()
+# The entries are evicted as soon as the data changes (see app/database/invalidation.py), so they can live for long
+PREFERENCES_CACHE_TTL = float(os.getenv("PREFERENCES_CACHE_TTL", "3600"))
+PREFERENCES_CACHE_MAX_USERS = int(os.getenv("PREFERENCES_CACHE_MAX_USERS", "10000"))
+
+
+class UserCache:
+    """In-process cache of per-user data (LRU on the users, with a TTL), evicted whenever the data of a user changes.
+
+    The cache is only used while it is enabled, i.e. while the invalidations of all the workers are being received. Loads racing
+    with an eviction are not stored: the clock is read before loading, and the value is only stored if the user was not evicted
+    since then (otherwise it could be older than the change that evicted it).
+    """
+    def __init__(self, ttl, max_users) -> None:
+        self.ttl = ttl
+        self.max_users = max_users
+        self.enabled = False
+        self._entries = OrderedDict()
+        self._evicted_at = OrderedDict()
+        self._clock = 0
+        # Eviction time of the users no longer tracked in _evicted_at (and of the last full flush)
+        self._floor = 0
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _is_stale(self, user_id, loaded_at):
+        return self._evicted_at.get(user_id, self._floor) >= loaded_at
+
+    async def get_or_load(self, user_id, key, loader):
+        """Returns a cached value, loading (and caching) it if needed
+
+        Args:
+            user_id (int): user the value belongs to
+            key (Hashable): key of the value among the ones of the user
+            loader (Callable[[], Awaitable]): zero-argument callable returning the coroutine that loads the value
+
+        Returns:
+            Any: the value
+        """
+        if not self.enabled:
+            return await loader()
+
+        user_entries = self._entries.get(user_id)
+        if user_entries is not None and key in user_entries:
+            value, expires_at = user_entries[key]
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                metrics.inc("preferences_cache_hits_total")
+                return value
+
+        metrics.inc("preferences_cache_misses_total")
+        loaded_at = self._tick()
+        value = await loader()
+        if self.enabled and not self._is_stale(user_id, loaded_at):
+            self._entries.setdefault(user_id, {})[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def evict_user(self, user_id):
+        """Evicts the values of a user (its data changed)"""
+        self._entries.pop(user_id, None)
+        self._evicted_at[user_id] = self._tick()
+        self._evicted_at.move_to_end(user_id)
+        while len(self._evicted_at) > self.max_users:
+            _, evicted_at = self._evicted_at.popitem(last=False)
+            self._floor = max(self._floor, evicted_at)
+        metrics.inc("preferences_cache_evictions_total")
+
+    def clear(self):
+        """Evicts the values of all the users"""
+        self._entries.clear()
+        self._evicted_at.clear()
+        self._floor = self._tick()
+        metrics.inc("preferences_cache_flushes_total")
+
+
+preferences_cache = UserCache(PREFERENCES_CACHE_TTL, PREFERENCES_CACHE_MAX_USERS)
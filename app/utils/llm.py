@@ -1,8 +1,45 @@
-from openai import OpenAI, RateLimitError, Timeout
+from openai import AsyncOpenAI, OpenAI, RateLimitError, Timeout
 from dotenv import load_dotenv
 import backoff
 import os
 import json
+import logging
+from app.utils.metrics import registry as metrics
+
+logger = logging.getLogger("llm")
+
+def _strict_json_schema(schema):
+    """Makes a JSON schema follow the rules of the strict structured outputs: every property of the objects is required, and no
+    additional properties are allowed"""
+    if isinstance(schema, dict):
+        schema = {key: _strict_json_schema(value) for key, value in schema.items()}
+        if schema.get("type") == "object" and "properties" in schema:
+            schema["required"] = list(schema["properties"])
+            schema["additionalProperties"] = False
+    elif isinstance(schema, list):
+        schema = [_strict_json_schema(item) for item in schema]
+
+    return schema
+
+
+def json_schema_response_format(response_schema):
+    """Builds the json_schema response format (strict structured outputs) of a pydantic model
+
+    Args:
+        response_schema (BaseModel): pydantic model the LLM response must follow
+
+    Returns:
+        dict: response_format argument of a chat completion request
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_schema.__name__,
+            "schema": _strict_json_schema(response_schema.model_json_schema()),
+            "strict": True,
+        },
+    }
+
 
 class LLM:
     """Abstract, parent class the children classes of which will be in charge of the system-LLM interaction.
@@ -20,17 +57,41 @@ class LLM:
 
     def generate_structured_response(self, prompt, temperature, max_new_tokens, additional_sampling_parameters) -> str:
         pass
+
+    async def agenerate_structured_response(self, prompt, response_schema, temperature, max_new_tokens, additional_sampling_parameters, stream) -> str:
+        pass
     
     def clean_tokens(self, token):        
         return token.replace("\n", "  \n").replace("```json", "").replace("```", "")
  
 class OpenAI_Generic(LLM):
-    def __init__(self, client, model, sampling_parameters = None) -> None:
+    def __init__(self, client, model, sampling_parameters = None, async_client = None) -> None:
         self.client = client
+        self.async_client = async_client
         self.model = model        
         self.sampling_parameters = sampling_parameters
+
+    def _build_model_args(self, prompt, temperature, max_new_tokens, additional_sampling_parameters = None):
+        """Builds the arguments of a chat completion request, combining the LLM specific sampling parameters with the additional ones"""
+        model_args = {
+            "model": self.model,
+            "messages": prompt,
+            "temperature": temperature,
+            "max_tokens": max_new_tokens,
+        }
+        if self.sampling_parameters:
+            model_args.update(self.sampling_parameters)
+        if additional_sampling_parameters:
+            for k, v in additional_sampling_parameters.items():
+                if k in model_args.keys():
+                    model_args[k] += v
+                else:
+                    model_args[k] = v
+
+        return model_args
     
-    def build_prompt(self, system_prompt, examples, inst_prompt):
+    @staticmethod
+    def build_prompt(system_prompt, examples, inst_prompt):
         """Prompt builder for OpenAI. It can take previous messages to enable in-context learning. It can also take images (if the underlying LLM supports it).
 
         Args:
@@ -179,11 +240,56 @@ class OpenAI_Generic(LLM):
                     model_args[k] = v
                 
         return json.loads(self.client.beta.chat.completions.parse(**model_args).choices[0].message.content)
+
+    @backoff.on_exception(backoff.expo, RateLimitError, max_tries=10)
+    async def agenerate_structured_response(self, prompt, response_schema, temperature, max_new_tokens, additional_sampling_parameters = None, stream = False):
+        """Async version of generate_structured_response. Being a coroutine, the generation can be cancelled at any time: cancelling it
+        closes the HTTP connection (or stream) to the LLM backend, so that the backend stops generating tokens nobody will read.
+
+        The response is decoded but not validated against the response schema, so that the caller can salvage the valid parts of it.
+
+        Args:
+            prompt (str): fully-formatted prompt
+            response_schema (BaseModel): pydantic model the LLM response must follow
+            temperature (float): LLM temperature to use
+            max_new_tokens (int): max new tokens to generate by the LLM
+            additional_sampling_parameters (dict, optional): dict of additional sampling parameters to use when generating. Defaults to None.
+            stream (bool, optional): whether to stream the generation from the LLM backend. Defaults to False.
+
+        Returns:
+            str: LLM response
+        """
+        model_args = self._build_model_args(prompt, temperature, max_new_tokens, additional_sampling_parameters)
+        # Sending the JSON schema (instead of the pydantic model) skips the client-side all-or-nothing validation
+        model_args["response_format"] = json_schema_response_format(response_schema)
+
+        if stream:
+            async with self.async_client.beta.chat.completions.stream(**model_args) as response_stream:
+                async for _ in response_stream:
+                    pass
+                completion = await response_stream.get_final_completion()
+        else:
+            completion = await self.async_client.beta.chat.completions.parse(**model_args)
+
+        if completion.usage is not None:
+            metrics.inc("llm_prompt_tokens_total", completion.usage.prompt_tokens, model=self.model)
+            metrics.inc("llm_completion_tokens_total", completion.usage.completion_tokens, model=self.model)
+
+        return json.loads(self.clean_tokens(completion.choices[0].message.content))
+
+    async def aclose(self):
+        """Closes the connections of the async client (if any)"""
+        if self.async_client is not None:
+            await self.async_client.close()
     
 class GenericLLM(OpenAI_Generic):
-    def __init__(self) -> None:
+    def __init__(self, model = None, sync_client = True) -> None:
         """The constructor gets the backend LLM serving's endpoint from the .env file       
 
+        Args:
+            model (str, optional): model to use, served by the same backend. Defaults to the LLM_MODEL_NAME of the .env file.
+            sync_client (bool, optional): whether to create the sync client too (the async methods only use the async one). Defaults to True.
+
         Raises:
             ValueError: If the LLM is not deployed
         """
@@ -196,9 +302,66 @@ class GenericLLM(OpenAI_Generic):
                 api_key=os.getenv("LLM_API_KEY"),
                 timeout=Timeout(120.0, connect=10.0),
                 max_retries=10
+            ) if sync_client else None
+            async_client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=os.getenv("LLM_API_KEY"),
+                timeout=Timeout(120.0, connect=10.0),
+                max_retries=10
             )
-            model = os.getenv("LLM_MODEL_NAME")
+            model = model or os.getenv("LLM_MODEL_NAME")
             sampling_parameters = None
-            OpenAI_Generic.__init__(self, client, model, sampling_parameters)
+            OpenAI_Generic.__init__(self, client, model, sampling_parameters, async_client)
         else:
-            raise ValueError("The selected model is not deployed.")
\ No newline at end of file
+            raise ValueError("The selected model is not deployed.")
+
+class ModelRouter:
+    """Routes the requests through an ordered list of model tiers, from the cheapest/fastest model to the largest one.
+    A request is first sent to the first tier it is routed to, and escalated to the next tier if its result is not good enough.
+
+    The routing policy is configured from the .env file:
+        - LLM_MODEL_TIERS: comma-separated models, from the smallest to the largest. Defaults to LLM_MODEL_NAME (a single tier).
+        - LLM_SMALL_TIER_MAX_INGREDIENTS: requests with more ingredients than this skip the first (smallest) tier.
+        - LLM_LARGE_TIER_USERS: comma-separated user IDs whose requests go straight to the last (largest) tier.
+    """
+    def __init__(self, tiers, small_tier_max_ingredients = None, large_tier_users = None) -> None:
+        if not tiers:
+            raise ValueError("At least one model tier is required.")
+        self.tiers = list(tiers)
+        self.small_tier_max_ingredients = small_tier_max_ingredients
+        self.large_tier_users = set(large_tier_users or [])
+
+    @classmethod
+    def from_env(cls):
+        load_dotenv()
+        tiers = [model.strip() for model in os.getenv("LLM_MODEL_TIERS", "").split(",") if model.strip()]
+        if not tiers:
+            tiers = [os.getenv("LLM_MODEL_NAME")]
+        small_tier_max_ingredients = os.getenv("LLM_SMALL_TIER_MAX_INGREDIENTS")
+        large_tier_users = []
+        for user_id in os.getenv("LLM_LARGE_TIER_USERS", "").split(","):
+            if not user_id.strip():
+                continue
+            try:
+                large_tier_users.append(int(user_id))
+            except ValueError:
+                logger.warning(f"Ignoring invalid user ID in LLM_LARGE_TIER_USERS: {user_id!r}")
+
+        return cls(tiers, int(small_tier_max_ingredients) if small_tier_max_ingredients else None, large_tier_users)
+
+    def route(self, user_id, ingredients_count):
+        """Returns the ordered models a request should go through
+
+        Args:
+            user_id (int): user making the request
+            ingredients_count (int): number of ingredients of the request
+
+        Returns:
+            list of str: models to try, in order
+        """
+        if user_id in self.large_tier_users:
+            return self.tiers[-1:]
+        if self.small_tier_max_ingredients is not None and ingredients_count > self.small_tier_max_ingredients and len(self.tiers) > 1:
+            return self.tiers[1:]
+
+        return list(self.tiers)
@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from app.utils.llm_scheduler import RequestPriority, scheduler
+from app.utils.metrics import registry as metrics
+
+load_dotenv()
+# Seconds between two checks of the client connection while a generation is running
+DISCONNECT_POLL_INTERVAL = float(os.getenv("LLM_DISCONNECT_POLL_INTERVAL", "0.25"))
+
+logger = logging.getLogger("llm_generations")
+
+_inflight = {}
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client went away before the generation it was waiting for finished."""
+
+
+class _InflightGeneration:
+    """An upstream LLM generation shared by all the requests waiting for the very same prompt."""
+    def __init__(self, key, task) -> None:
+        self.key = key
+        self.task = task
+        self.waiters = 0
+
+
+def generation_key(*parts):
+    """Builds the key identifying an upstream generation, so that identical concurrent requests share a single LLM call.
+
+    Args:
+        parts: anything determining the LLM response (model, prompt, sampling parameters...). Must be JSON serializable.
+
+    Returns:
+        str: generation key
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+async def _run_in_slot(generation_factory, user_id, priority):
+    """Runs the generation holding one of the LLM concurrency slots, given by the fair scheduler. The slot is released as soon
+    as the generation finishes or is cancelled."""
+    async with scheduler.slot(user_id, priority):
+        metrics.add_gauge("llm_generations_inflight", 1)
+        start = time.perf_counter()
+        try:
+            return await generation_factory()
+        finally:
+            metrics.add_gauge("llm_generations_inflight", -1)
+            metrics.observe("llm_generation_seconds", time.perf_counter() - start)
+
+
+async def _wait_for_disconnect(request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+
+async def run_generation(request, key, generation_factory, user_id = None, priority = RequestPriority.interactive):
+    """Runs an upstream LLM generation on behalf of a request, aborting it if the client disconnects.
+
+    Requests with the same key share a single upstream generation. The generation is cancelled (closing the HTTP connection
+    or stream to the LLM backend and releasing its concurrency slot) only when no remaining waiter still needs it.
+
+    Args:
+        request (Request): incoming request whose connection is watched. If None, the connection is not watched.
+        key (str): generation key (see generation_key)
+        generation_factory (Callable[[], Awaitable]): zero-argument callable returning the generation coroutine
+        user_id (int, optional): user on behalf of whom the generation is scheduled. Defaults to None (anonymous).
+        priority (RequestPriority, optional): scheduling priority. Defaults to interactive.
+
+    Raises:
+        ClientDisconnected: if the client disconnected before the generation finished
+
+    Returns:
+        Any: the generation result
+    """
+    inflight = _inflight.get(key)
+    if inflight is None:
+        inflight = _InflightGeneration(key, asyncio.create_task(_run_in_slot(generation_factory, user_id, priority)))
+        _inflight[key] = inflight
+        inflight.task.add_done_callback(lambda _: _inflight.pop(key, None) if _inflight.get(key) is inflight else None)
+    else:
+        metrics.inc("llm_generations_shared_total")
+    inflight.waiters += 1
+
+    watcher = asyncio.create_task(_wait_for_disconnect(request)) if request is not None else None
+    try:
+        if watcher is None:
+            return await asyncio.shield(inflight.task)
+        done, _ = await asyncio.wait({inflight.task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if inflight.task in done:
+            return inflight.task.result()
+        raise ClientDisconnected()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        inflight.waiters -= 1
+        if inflight.waiters == 0 and not inflight.task.done():
+            logger.info("Cancelling upstream LLM generation %s: no client is waiting for it anymore", key[:12])
+            metrics.inc("llm_generations_cancelled_total")
+            inflight.task.cancel()
+            if _inflight.get(key) is inflight:
+                _inflight.pop(key, None)
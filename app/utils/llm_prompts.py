@@ -27,4 +27,42 @@ RECIPES_GENERATION_INST = RECIPES_GENERATION_INST_COMMON + """Return your respon
 ]
 """
 
-RECIPES_GENERATION_INST_STRUCTURED = RECIPES_GENERATION_INST_COMMON
\ No newline at end of file
+RECIPES_GENERATION_INST_STRUCTURED = RECIPES_GENERATION_INST_COMMON
+
+RECIPES_PLANNING_SYS = "You are a helpful assistant that plans varied recipes from a list of ingredients enclosed in triple quotes."
+RECIPES_PLANNING_INST = """Plan recipes using the user's preferences enclosed in triple quotes. \
+Prioritize the user's liked ingredients over the ones without preferences.
+
+Return an empty list if no recipes can be generated (i.e., insufficient ingredients for being considered complete with culinary sense).
+
+List of ingredients and preferences:
+'''{preferences}'''
+
+Return only the titles of up to five clearly different recipes, depending on the number of available ingredients."""
+
+RECIPE_GENERATION_INST = """Generate a single recipe ({recipe}) using the user's preferences enclosed in triple quotes. \
+Prioritize the user's liked ingredients over the ones without preferences.
+
+List of ingredients and preferences:
+'''{preferences}'''
+
+The recipe should be complete and make culinary sense."""
+
+# Fixed diversity scheme of the parallel generation, used instead of the planning call (it does not detect insufficient ingredients)
+RECIPE_DIVERSITY_STYLES = [
+    "a quick and easy dish",
+    "a salad or a cold dish",
+    "a soup or a stew",
+    "an oven-baked dish",
+    "a dish from another cuisine",
+]
+
+RECIPE_REPAIR_SYS = "You are a helpful assistant that fixes recipes in JSON format so that they follow a given schema."
+RECIPE_REPAIR_INST = """The following recipe, enclosed in triple quotes, does not follow the expected schema. Fix it keeping its contents, \
+and return only the fixed recipe.
+
+Recipe:
+'''{recipe}'''
+
+Validation errors:
+'''{errors}'''"""
@@ -0,0 +1,163 @@
+import asyncio
+import enum
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from app.utils.metrics import registry as metrics
+
+load_dotenv()
+# Max number of upstream LLM generations running at the same time (per worker)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Max number of upstream LLM generations running at the same time for a single user (per worker). The default lets the 5 recipes
+# of a parallel-mode request be generated at the same time
+LLM_PER_USER_CONCURRENCY = int(os.getenv("LLM_PER_USER_CONCURRENCY", "5"))
+# Scheduling weights of some users (e.g. "42:3,7:2"), the rest of them have a weight of 1
+LLM_USER_WEIGHTS = os.getenv("LLM_USER_WEIGHTS", "")
+
+
+class RequestPriority(str, enum.Enum):
+    """Priority classes of the LLM work: interactive requests are always served before batch/background ones"""
+    interactive = "interactive"
+    batch = "batch"
+
+
+def parse_user_weights(weights):
+    """Parses the "user_id:weight,..." weights configuration"""
+    parsed_weights = {}
+    for entry in weights.split(","):
+        if entry.strip():
+            user_id, weight = entry.split(":")
+            parsed_weights[int(user_id)] = max(1, int(weight))
+
+    return parsed_weights
+
+
+class _PriorityClass:
+    """Per-user FIFO queues of a priority class, served in weighted round-robin"""
+    def __init__(self) -> None:
+        self.queues = {}
+        self.ring = deque()
+        self.credits = {}
+
+
+class FairScheduler:
+    """Weighted fair scheduler of the LLM capacity across users.
+
+    Each user has a queue of waiting requests. The queues are served in round-robin, a user with weight w getting up to w
+    slots per turn, so that a single user sending many requests at once cannot take all the capacity and starve the rest.
+    A user never holds more than per_user_limit slots, and interactive requests go ahead of batch ones.
+    """
+    def __init__(self, capacity, per_user_limit, weights = None) -> None:
+        self.capacity = capacity
+        self.per_user_limit = per_user_limit
+        self.weights = weights or {}
+        self._active = 0
+        self._running = {}
+        self._classes = {priority: _PriorityClass() for priority in RequestPriority}
+
+    def _weight(self, user_id):
+        return self.weights.get(user_id, 1)
+
+    def _can_run(self, user_id):
+        return self._running.get(user_id, 0) < self.per_user_limit
+
+    def _next_waiter(self, priority_class):
+        ring = priority_class.ring
+        for _ in range(len(ring)):
+            if not ring:
+                break
+            user_id = ring[0]
+            queue = priority_class.queues[user_id]
+            # Skip the waiters cancelled while queued (they remove themselves once they resume)
+            while queue and queue[0].done():
+                queue.popleft()
+            if not queue:
+                ring.popleft()
+                del priority_class.queues[user_id]
+                priority_class.credits.pop(user_id, None)
+                continue
+            if self._can_run(user_id):
+                if priority_class.credits.get(user_id, 0) <= 0:
+                    priority_class.credits[user_id] = self._weight(user_id)
+                priority_class.credits[user_id] -= 1
+                waiter = queue.popleft()
+                if not queue:
+                    ring.popleft()
+                    del priority_class.queues[user_id]
+                    priority_class.credits.pop(user_id, None)
+                elif priority_class.credits[user_id] == 0:
+                    # Turn finished: next user
+                    ring.rotate(-1)
+                return user_id, waiter
+            ring.rotate(-1)
+
+        return None
+
+    def _dispatch(self):
+        while self._active < self.capacity:
+            for priority in RequestPriority:
+                next_waiter = self._next_waiter(self._classes[priority])
+                if next_waiter is not None:
+                    break
+            else:
+                return
+            user_id, waiter = next_waiter
+            self._active += 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            waiter.set_result(None)
+
+    def _remove_waiter(self, user_id, priority, waiter):
+        priority_class = self._classes[priority]
+        queue = priority_class.queues.get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                priority_class.ring.remove(user_id)
+                del priority_class.queues[user_id]
+                priority_class.credits.pop(user_id, None)
+
+    async def acquire(self, user_id, priority = RequestPriority.interactive):
+        """Waits until the user is given a slot"""
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        priority_class = self._classes[priority]
+        if user_id not in priority_class.queues:
+            priority_class.queues[user_id] = deque()
+            priority_class.ring.append(user_id)
+        priority_class.queues[user_id].append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was given right before the cancellation
+                self.release(user_id)
+            else:
+                self._remove_waiter(user_id, priority, waiter)
+            raise
+        wait = time.perf_counter() - start
+        metrics.observe("llm_queue_wait_seconds", wait, priority=priority.value)
+        # Per-user summaries only for the configured users (one per user seen would grow without bound)
+        if user_id in self.weights:
+            metrics.observe("llm_user_queue_wait_seconds", wait, user=user_id)
+
+    def release(self, user_id):
+        self._active -= 1
+        self._running[user_id] -= 1
+        if self._running[user_id] == 0:
+            del self._running[user_id]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id, priority = RequestPriority.interactive):
+        await self.acquire(user_id, priority)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+
+scheduler = FairScheduler(LLM_MAX_CONCURRENCY, LLM_PER_USER_CONCURRENCY, parse_user_weights(LLM_USER_WEIGHTS))
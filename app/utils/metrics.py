@@ -0,0 +1,96 @@
+import threading
+from collections import defaultdict, deque
+
+# Number of most recent observations kept per summary to compute the quantiles
+SUMMARY_WINDOW = 1024
+
+
+def _metric_key(name, labels):
+    """Builds a Prometheus-like key (e.g. llm_requests_total{tier="small"}) from a metric name and its labels."""
+    if not labels:
+        return name
+    formatted_labels = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{formatted_labels}}}"
+
+
+class MetricsRegistry:
+    """In-process registry of counters, gauges and summaries (latencies, wait times...).
+
+    Metrics are kept per worker process and exported as a JSON document through the admin API.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._summaries = {}
+
+    def inc(self, name, value=1, **labels):
+        """Increments a counter by the given value"""
+        with self._lock:
+            self._counters[_metric_key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        """Sets a gauge to the given value"""
+        with self._lock:
+            self._gauges[_metric_key(name, labels)] = value
+
+    def add_gauge(self, name, delta, **labels):
+        """Adds the given delta (which can be negative) to a gauge"""
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name, value, **labels):
+        """Records an observation (e.g. a latency in seconds) in a summary"""
+        key = _metric_key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = {"count": 0, "sum": 0.0, "min": value, "max": value, "window": deque(maxlen=SUMMARY_WINDOW)}
+                self._summaries[key] = summary
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["min"] = min(summary["min"], value)
+            summary["max"] = max(summary["max"], value)
+            summary["window"].append(value)
+
+    def get_counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(_metric_key(name, labels), 0)
+
+    def get_gauge(self, name, **labels):
+        with self._lock:
+            return self._gauges.get(_metric_key(name, labels), 0)
+
+    def snapshot(self):
+        """Returns a copy of all the metrics, computing the p50/p95/p99 quantiles of the summaries"""
+        with self._lock:
+            summaries = {}
+            for key, summary in self._summaries.items():
+                window = sorted(summary["window"])
+                summaries[key] = {
+                    "count": summary["count"],
+                    "sum": summary["sum"],
+                    "min": summary["min"],
+                    "max": summary["max"],
+                    "p50": _quantile(window, 0.50),
+                    "p95": _quantile(window, 0.95),
+                    "p99": _quantile(window, 0.99),
+                }
+            return {"counters": dict(self._counters), "gauges": dict(self._gauges), "summaries": summaries}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:  # pragma: no cover - optional dependency
+    Profiler = None
+
+load_dotenv()
+# Profiling is opt-in: when disabled, the middleware is not even installed
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+# Fraction of the requests whose profile is always saved
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0.01"))
+# Requests slower than this (in seconds) always get their profile saved. Empty to only sample requests
+PROFILING_SLOW_THRESHOLD = os.getenv("PROFILING_SLOW_THRESHOLD", "2.0")
+PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", "0.001"))
+PROFILING_DIR = os.getenv("PROFILING_DIR", "profiles")
+# Max number of profiles kept on disk (the oldest ones are deleted)
+PROFILING_MAX_FILES = int(os.getenv("PROFILING_MAX_FILES", "200"))
+
+PROFILE_SUFFIX = ".speedscope.json"
+_PROFILE_NAME_PATTERN = re.compile(r"^[\w.-]+" + re.escape(PROFILE_SUFFIX) + "$")
+
+logger = logging.getLogger("profiling")
+
+
+def profiling_available():
+    if PROFILING_ENABLED and Profiler is None:
+        logger.warning("Profiling is enabled but pyinstrument is not installed: profiling disabled")
+    return PROFILING_ENABLED and Profiler is not None
+
+
+def _slow_threshold():
+    return float(PROFILING_SLOW_THRESHOLD) if PROFILING_SLOW_THRESHOLD else None
+
+
+def _profile_name(scope, duration, reason):
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    path = re.sub(r"[^\w-]+", "_", scope["path"]).strip("_") or "root"
+    return f"{timestamp}_{scope['method']}_{path}_{int(duration * 1000)}ms_{reason}{PROFILE_SUFFIX}"
+
+
+def _save_profile(profiler, name):
+    os.makedirs(PROFILING_DIR, exist_ok=True)
+    with open(os.path.join(PROFILING_DIR, name), "w") as profile_file:
+        profile_file.write(profiler.output(SpeedscopeRenderer()))
+
+    # Rotate the profiles (their names start with their timestamp)
+    profiles = sorted(list_profiles(), key=lambda profile: profile["name"])
+    for profile in profiles[:max(0, len(profiles) - PROFILING_MAX_FILES)]:
+        os.remove(os.path.join(PROFILING_DIR, profile["name"]))
+
+
+class ProfileRequestsMiddleware:
+    """Profiles the requests with a low-overhead sampling profiler, saving the profiles of a sample of them and of the slow ones
+    as speedscope (flamegraph) files. Only installed when profiling is enabled.
+
+    It is a pure ASGI middleware, so that the endpoints can still watch the client connection (see app.main.CatchExceptionsMiddleware).
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/admin"):
+            await self.app(scope, receive, send)
+            return
+        slow_threshold = _slow_threshold()
+        sampled = random.random() < PROFILING_SAMPLE_RATE
+        if not sampled and slow_threshold is None:
+            await self.app(scope, receive, send)
+            return
+
+        profiler = Profiler(interval=PROFILING_INTERVAL, async_mode="enabled")
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            duration = time.perf_counter() - start
+            is_slow = slow_threshold is not None and duration >= slow_threshold
+            if is_slow or sampled:
+                name = _profile_name(scope, duration, "slow" if is_slow else "sampled")
+                try:
+                    await asyncio.to_thread(_save_profile, profiler, name)
+                    logger.info("Saved profile %s", name)
+                except OSError as e:
+                    logger.error(f"Could not save profile {name}: {e}")
+
+
+def list_profiles():
+    """Lists the saved profiles
+
+    Returns:
+        list of dicts: name, size (in bytes) and creation date of each profile, newest first
+    """
+    if not os.path.isdir(PROFILING_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILING_DIR):
+        path = os.path.join(PROFILING_DIR, name)
+        if _PROFILE_NAME_PATTERN.match(name) and os.path.isfile(path):
+            stat = os.stat(path)
+            profiles.append({
+                "name": name,
+                "size": stat.st_size,
+                "created_at": datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+            })
+
+    return sorted(profiles, key=lambda profile: profile["name"], reverse=True)
+
+
+def profile_path(name):
+    """Returns the path of a saved profile, or None if there is no such profile (names are validated against path traversal)"""
+    if not _PROFILE_NAME_PATTERN.match(name):
+        return None
+    path = os.path.join(PROFILING_DIR, name)
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,71 @@
+import re
+from difflib import SequenceMatcher
+from pydantic import ValidationError
+from app.schemas.schema_recipes import Recipe
+
+# Names at least this similar (difflib ratio of the normalized names) are considered the same recipe
+NAME_SIMILARITY_THRESHOLD = 0.85
+
+
+class UnexpectedStructuredOutput(ValueError):
+    """The structured LLM response does not have the expected shape"""
+
+
+def _recipe_items(llm_response):
+    """Returns the list of recipe items of a structured LLM response"""
+    if isinstance(llm_response, list):
+        return llm_response
+    # Some models wrap the list in an object (e.g. {"recipes": [...]})
+    if isinstance(llm_response, dict):
+        lists = [value for value in llm_response.values() if isinstance(value, list)]
+        if len(lists) == 1:
+            return lists[0]
+    raise UnexpectedStructuredOutput(f"Unexpected structured output: expected a list of recipes, got {type(llm_response).__name__}")
+
+
+def split_recipes(llm_response):
+    """Validates each recipe of a structured LLM response on its own (applying the Recipe coercions), instead of rejecting the
+    whole response because of a single malformed recipe
+
+    Args:
+        llm_response (list or dict): structured LLM response (decoded JSON)
+
+    Raises:
+        UnexpectedStructuredOutput: if the response is not a list of recipes
+
+    Returns:
+        tuple: list of valid Recipe, list of (invalid item, ValidationError) tuples
+    """
+    valid_recipes, invalid_items = [], []
+    for item in _recipe_items(llm_response):
+        try:
+            valid_recipes.append(Recipe.model_validate(item))
+        except ValidationError as e:
+            invalid_items.append((item, e))
+
+    return valid_recipes, invalid_items
+
+
+def _normalize_name(name):
+    return " ".join(re.sub(r"[^\w\s]", " ", name.lower()).split())
+
+
+def drop_near_duplicates(items, key = lambda item: item, threshold = NAME_SIMILARITY_THRESHOLD):
+    """Drops the items whose name is (nearly) the same as the name of a previous one, e.g. "Tomato Salad" and "Tomato salad!"
+
+    Args:
+        items (list): items to deduplicate (recipe titles, Recipe...), in order of preference
+        key (Callable, optional): returns the name of an item. Defaults to the item itself.
+        threshold (float, optional): min similarity ratio of two near-duplicate names. Defaults to NAME_SIMILARITY_THRESHOLD.
+
+    Returns:
+        list: the first item of each group of near-duplicates, in order
+    """
+    kept, kept_names = [], []
+    for item in items:
+        name = _normalize_name(key(item))
+        if not any(SequenceMatcher(None, name, kept_name).ratio() >= threshold for kept_name in kept_names):
+            kept.append(item)
+            kept_names.append(name)
+
+    return kept
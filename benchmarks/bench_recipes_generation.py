@@ -0,0 +1,138 @@
+"""Benchmark of the recipes generation modes (a single LLM call vs a planning call and parallel per-recipe calls) against a local
+stub of an OpenAI-compatible LLM backend, whose latency grows with the number of generated tokens (as with real LLMs).
+
+    python -m benchmarks.bench_recipes_generation --iterations 5 --seconds-per-token 0.005
+
+Both modes generate the same five recipes, and the latency, LLM calls and tokens (as reported by the stub) of each mode are compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import statistics
+import time
+
+# The LLM backend is the stub started by the benchmark. The app modules create their (unused here) engine when imported
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+os.environ["LLM_API_KEY"] = "stub"
+os.environ["LLM_MODEL_NAME"] = "stub-model"
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+STUB_TITLES = ["Tomato and Basil Pasta", "Caprese Salad", "Roasted Tomato Soup", "Stuffed Baked Tomatoes", "Shakshuka"]
+STUB_STEPS = 12
+
+
+def _stub_recipe(name):
+    return {
+        "name": name,
+        "ingredients_quantities": [{"ingredient": ingredient, "quantity": "200 g"} for ingredient in ["tomato", "basil", "onion", "garlic", "olive oil"]],
+        "instructions": "\n".join(f"Step {step}: prepare, season and cook the ingredients of the {name.lower()} for a few minutes, stirring often." for step in range(1, STUB_STEPS + 1)),
+        "estimated_cooking_time": "30",
+        "difficulty_level": "Easy",
+        "calories": "350",
+        "servings": 2,
+    }
+
+
+def _tokens(text):
+    # About 4 characters per token
+    return max(1, len(text) // 4)
+
+
+def create_stub_app(first_token_latency, seconds_per_token):
+    stub_app = FastAPI()
+    stub_app.state.calls = 0
+
+    @stub_app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = json.dumps(body["messages"])
+        schema_name = body.get("response_format", {}).get("json_schema", {}).get("name")
+        if schema_name == "RecipePlan":
+            content = json.dumps({"titles": STUB_TITLES})
+        elif schema_name == "Recipe":
+            title = re.search(r'titled \\"(.+?)\\"', prompt)
+            content = json.dumps(_stub_recipe(title.group(1) if title else STUB_TITLES[0]))
+        else:
+            content = json.dumps([_stub_recipe(title) for title in STUB_TITLES])
+
+        completion_tokens = _tokens(content)
+        stub_app.state.calls += 1
+        await asyncio.sleep(first_token_latency + completion_tokens * seconds_per_token)
+        return {
+            "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": _tokens(prompt), "completion_tokens": completion_tokens, "total_tokens": _tokens(prompt) + completion_tokens},
+        }
+
+    return stub_app
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def benchmark(mode, iterations, stub_app):
+    from app.api import endpoints_recipes
+    from app.utils.metrics import registry as metrics
+
+    generate = endpoints_recipes.generate_recipes_parallel if mode == "parallel" else endpoints_recipes.generate_recipes
+    preferences = {"tomato": "liked", "basil": "liked", "onion": "no preference", "garlic": "no preference", "olive oil": "no preference"}
+    latencies, recipes = [], 0
+    calls = stub_app.state.calls
+    prompt_tokens = metrics.get_counter("llm_prompt_tokens_total", model="stub-model")
+    completion_tokens = metrics.get_counter("llm_completion_tokens_total", model="stub-model")
+    for iteration in range(iterations):
+        start = time.perf_counter()
+        # Different users, so that the identical generations of the iterations are not shared
+        recipe_list = await generate(None, "stub-model", preferences, user_id=iteration + 1)
+        latencies.append(time.perf_counter() - start)
+        recipes += len(recipe_list.root)
+
+    return {
+        "latency_mean": statistics.mean(latencies),
+        "latency_max": max(latencies),
+        "recipes": recipes / iterations,
+        "calls": (stub_app.state.calls - calls) / iterations,
+        "prompt_tokens": (metrics.get_counter("llm_prompt_tokens_total", model="stub-model") - prompt_tokens) / iterations,
+        "completion_tokens": (metrics.get_counter("llm_completion_tokens_total", model="stub-model") - completion_tokens) / iterations,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=3, help="recipe generations per mode")
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="seconds before the stub generates the first token")
+    parser.add_argument("--seconds-per-token", type=float, default=0.005, help="seconds the stub takes per generated token")
+    args = parser.parse_args()
+
+    port = _free_port()
+    os.environ["LLM_ENDPOINT"] = f"http://127.0.0.1:{port}/v1"
+    stub_app = create_stub_app(args.first_token_latency, args.seconds_per_token)
+    server = uvicorn.Server(uvicorn.Config(stub_app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    from app.utils.llm_scheduler import LLM_MAX_CONCURRENCY, LLM_PER_USER_CONCURRENCY
+    # The app configuration is used as is (e.g. from the .env file): print what affects the parallel mode
+    print(f"LLM_MAX_CONCURRENCY={LLM_MAX_CONCURRENCY} LLM_PER_USER_CONCURRENCY={LLM_PER_USER_CONCURRENCY}")
+    try:
+        print(f"{'mode':<10}{'mean s':>9}{'max s':>9}{'recipes':>9}{'calls':>7}{'prompt tok':>12}{'output tok':>12}")
+        for mode in ["single", "parallel"]:
+            result = await benchmark(mode, args.iterations, stub_app)
+            print(f"{mode:<10}{result['latency_mean']:>9.2f}{result['latency_max']:>9.2f}{result['recipes']:>9.1f}{result['calls']:>7.1f}"
+                  f"{result['prompt_tokens']:>12.0f}{result['completion_tokens']:>12.0f}")
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
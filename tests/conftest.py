@@ -1,10 +1,24 @@
 # conftest.py
+import os
 import pytest
-from app.database.database import async_engine
+
+# A dedicated test database (e.g. TEST_DATABASE_URL=sqlite+aiosqlite:///test_recipes.db for fast, hermetic runs) replaces the
+# DATABASE_URL of the project. It must be set before the app (and its engine) is imported
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if TEST_DATABASE_URL:
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+
+from app.database.database import async_engine, Base
+import app.models.models_ingredients  # noqa: F401 (registers the tables)
 
 @pytest.fixture(scope="session", autouse=True)
 async def close_db_engine():
-    # Do nothing before the tests run
+    # Create the tables (the app lifespan does not run with the test clients). A dedicated test database starts empty
+    async with async_engine.begin() as conn:
+        if TEST_DATABASE_URL:
+            await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    await async_engine.dispose()
     yield
     # Dispose of the engine to close all connections.
     await async_engine.dispose()
@@ -1,10 +1,17 @@
 # tests/test_api.py
+import asyncio
+import json
+import os
+from urllib.parse import urlencode
 import pytest
 from httpx import ASGITransport, AsyncClient
 import pytest_asyncio
+from app.api import endpoints_recipes
 from app.main import app
 from app.schemas.schema_recipes import RecipeList
 from app.database.database import async_engine
+from app.utils import profiling
+from app.utils.metrics import registry as metrics
 
 
 @pytest_asyncio.fixture(scope="module", loop_scope="module", autouse=True)
@@ -120,6 +127,119 @@ async def test_list_ingredients():
     for ing in ingredients:
         assert ing["ingredient"] in ingredient_names
 
+@pytest.mark.asyncio(loop_scope="module")
+async def test_list_ingredients_conditional_get():
+    user_id = 8
+    payload = {"user_id": user_id, "ingredient": "basil", "preference": "liked"}
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        await client.post("/ingredients/", json=payload)
+        response = await client.get("/ingredients/", params={"user_id": user_id})
+        assert response.status_code == 200, response.text
+        etag = response.headers["etag"]
+
+        # Unchanged preferences: 304 without body
+        response = await client.get("/ingredients/", params={"user_id": user_id}, headers={"If-None-Match": etag})
+        assert response.status_code == 304, response.text
+        assert response.content == b""
+
+        # Any write changes the ETag
+        await client.put("/ingredients/basil", params={"user_id": user_id}, json={"preference": "disliked"})
+        response = await client.get("/ingredients/", params={"user_id": user_id}, headers={"If-None-Match": etag})
+        assert response.status_code == 200, response.text
+        assert response.headers["etag"] != etag
+        assert response.json()[0]["preference"] == "disliked"
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_import_export_ingredients():
+    user_id = 9
+    body = (
+        "user_id,ingredient,preference\n"
+        f"{user_id},rosemary,liked\n"
+        f"{user_id},thyme,disliked\n"
+        f"{user_id},thyme,disliked\n"
+        f"{user_id},sage,unknown\n"
+        f'{user_id},"herbes de\nprovence",liked\n'
+    )
+    secret_key = os.getenv("CLEAN_DATABASE_PASSWORD")
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/ingredients/import", params={"format": "csv", "secret_key": "wrong"}, content=body)
+        assert response.status_code == 403, response.text
+        response = await client.get("/ingredients/export")
+        assert response.status_code == 403, response.text
+
+        response = await client.post("/ingredients/import", params={"format": "csv", "secret_key": secret_key}, content=body)
+        assert response.status_code == 200, response.text
+        data = response.json()
+        assert data["received"] == 5
+        assert data["invalid"] == 1
+        assert data["duplicates"] == 1
+        assert data["inserted"] + data["unchanged"] == 3
+
+        response = await client.get("/ingredients/export", params={"user_id": user_id})
+        assert response.status_code == 200, response.text
+        exported = [json.loads(line) for line in response.text.splitlines()]
+    assert {(item["ingredient"], item["preference"]) for item in exported} == {("rosemary", "liked"), ("thyme", "disliked"), ("herbes de\nprovence", "liked")}
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_admin_profiles_require_the_secret_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    name = "20250101T000000000000Z_GET_recipes_2500ms_slow" + profiling.PROFILE_SUFFIX
+    (tmp_path / name).write_text('{"profiles": []}')
+    secret_key = os.getenv("CLEAN_DATABASE_PASSWORD")
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/admin/profiles", params={"secret_key": "wrong"})
+        assert response.status_code == 403, response.text
+        response = await client.get(f"/admin/profiles/{name}", params={"secret_key": "wrong"})
+        assert response.status_code == 403, response.text
+
+        response = await client.get("/admin/profiles", params={"secret_key": secret_key})
+        assert response.status_code == 200, response.text
+        assert [profile["name"] for profile in response.json()] == [name]
+        response = await client.get(f"/admin/profiles/{name}", params={"secret_key": secret_key})
+        assert response.status_code == 200, response.text
+        assert response.json() == {"profiles": []}
+        response = await client.get("/admin/profiles/missing" + profiling.PROFILE_SUFFIX, params={"secret_key": secret_key})
+        assert response.status_code == 404, response.text
+
+async def get_through_profiling_middleware(path, params = None):
+    pytest.importorskip("pyinstrument")
+    transport = ASGITransport(app=profiling.ProfileRequestsMiddleware(app))
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get(path, params=params)
+    assert response.status_code == 200, response.text
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_profiling_middleware_saves_slow_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "PROFILING_SAMPLE_RATE", 0)
+    # Every request is slow
+    monkeypatch.setattr(profiling, "PROFILING_SLOW_THRESHOLD", "0")
+
+    await get_through_profiling_middleware("/ingredients/", {"user_id": 1})
+    profiles = profiling.list_profiles()
+    assert len(profiles) == 1
+    assert "_GET_ingredients_" in profiles[0]["name"]
+    assert profiles[0]["name"].endswith("ms_slow" + profiling.PROFILE_SUFFIX)
+    with open(os.path.join(tmp_path, profiles[0]["name"])) as profile_file:
+        assert "speedscope" in profile_file.read()
+
+    # The admin routes are never profiled
+    await get_through_profiling_middleware("/admin/profiles", {"secret_key": os.getenv("CLEAN_DATABASE_PASSWORD")})
+    assert len(profiling.list_profiles()) == 1
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_profiling_middleware_skips_unsampled_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "PROFILING_SAMPLE_RATE", 0)
+    monkeypatch.setattr(profiling, "PROFILING_SLOW_THRESHOLD", "")
+
+    await get_through_profiling_middleware("/ingredients/", {"user_id": 1})
+    assert profiling.list_profiles() == []
+
 @pytest.mark.asyncio(loop_scope="module")
 async def test_create_recipes_with_disliked_ingredients():
     user_id = 11
@@ -165,4 +285,72 @@ async def test_create_recipes():
         assert response is not None
         recipe_list_obj = RecipeList.model_validate(response.json())
         assert recipe_list_obj
-        assert len(recipe_list_obj.root) > 0
\ No newline at end of file
+        assert len(recipe_list_obj.root) > 0
+async def asgi_request_until_disconnect(asgi_app, path, params, disconnect):
+    """Sends a GET request straight through the ASGI interface of the app (and thus its whole middleware stack), the client
+    disconnecting once the disconnect event is set (unlike ASGITransport, which never reports a disconnection)
+
+    Returns:
+        int: status code of the response
+    """
+    messages = []
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": urlencode(params, doseq=True).encode(),
+        "headers": [(b"host", b"test")], "client": ("127.0.0.1", 12345), "server": ("test", 80),
+    }
+    await asgi_app(scope, receive, send)
+    return next(message["status"] for message in messages if message["type"] == "http.response.start")
+
+@pytest.mark.asyncio(loop_scope="module")
+@pytest.mark.parametrize("profiled", [False, True])
+async def test_create_recipes_aborted_when_the_client_disconnects(profiled, tmp_path, monkeypatch):
+    upstream_cancelled = asyncio.Event()
+    asgi_app = app
+    if profiled:
+        pytest.importorskip("pyinstrument")
+        monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+        monkeypatch.setattr(profiling, "PROFILING_SLOW_THRESHOLD", "0")
+        asgi_app = profiling.ProfileRequestsMiddleware(app)
+
+    class StubLLM:
+        def __init__(self, model, sync_client = True):
+            pass
+
+        async def agenerate_structured_response(self, prompt, response_schema, temperature, max_new_tokens, stream = False):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                upstream_cancelled.set()
+                raise
+
+        async def aclose(self):
+            pass
+
+    monkeypatch.setattr(endpoints_recipes, "GenericLLM", StubLLM)
+    cancelled_before = metrics.get_counter("llm_generations_cancelled_total")
+    disconnect = asyncio.Event()
+    response = asyncio.create_task(asgi_request_until_disconnect(
+        asgi_app, "/recipes/", {"user_id": 19, "ingredients": ["saffron", "rice", "peas"]}, disconnect
+    ))
+    await asyncio.sleep(0.2)
+    assert not response.done()
+    disconnect.set()
+
+    # The disconnection goes through the middlewares: the upstream generation is aborted
+    assert await asyncio.wait_for(response, timeout=5) == 499
+    await asyncio.wait_for(upstream_cancelled.wait(), timeout=5)
+    assert metrics.get_counter("llm_generations_cancelled_total") == cancelled_before + 1
@@ -1,23 +1,45 @@
 # tests/test_crud.py
+import asyncio
+import os
+import re
 import pytest
 import pytest_asyncio
+from sqlalchemy import insert
 from fastapi import HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from app.api import endpoints_recipes
 from app.api.endpoints_recipes import create_recipes
-from app.database.database import async_engine, async_sessionmaker
+from app.database.database import async_engine
+from app.crud import ingredient_preferences_bulk
+from app.crud.group_commit import GroupCommitWriter
+from app.database.invalidation import InvalidationListener
+from app.database.rebalance import rebalance
+from app.database.sharding import ConsistentHashRing, ShardedDatabase, shards
 from app.crud.ingredient_preferences_crud import (
     create_ingredient,
     get_ingredient,
     update_ingredient,
     delete_ingredient,
     list_ingredients,
+    get_preferences_version,
 )
+from app.server import configure_db_pool, worker_shutdown_timeout
+from app.models.models_ingredients import IngredientPreference
 from app.schemas.schema_ingredients import (
+    BulkFormat,
     IngredientPreferenceCreate,
     IngredientPreferenceUpdate,
     PreferenceEnum,
 )
-from app.schemas.schema_recipes import RecipeList
+from app.schemas.schema_recipes import RecipeList, RecipePlan, RecipesGenerationMode
+from app.utils.admission import AdaptiveConcurrencyLimiter
+from app.utils.cache import UserCache
+from app.utils.llm import ModelRouter, json_schema_response_format
+from app.utils.llm_generations import ClientDisconnected, run_generation
+from app.utils.llm_scheduler import FairScheduler, RequestPriority
+from app.utils import profiling
+from app.utils.metrics import registry as metrics
+from app.utils.recipes_validation import drop_near_duplicates, split_recipes
 
 @pytest_asyncio.fixture(autouse=True, loop_scope="module")
 async def db_session():
@@ -110,6 +132,19 @@ async def test_get_update_delete_ingredient(db_session: AsyncSession):
     record_after_delete = await get_ingredient(db_session, user_id, ingredient)
     assert record_after_delete is None
 
+@pytest.mark.asyncio(loop_scope="module")
+async def test_preferences_version_bumped_by_writes(db_session: AsyncSession):
+    user_id = 6
+    ingredient = "basil"
+    version = await get_preferences_version(db_session, user_id)
+
+    await create_ingredient(db_session, IngredientPreferenceCreate(user_id=user_id, ingredient=ingredient, preference=PreferenceEnum.liked))
+    assert await get_preferences_version(db_session, user_id) == version + 1
+    await update_ingredient(db_session, user_id, ingredient, IngredientPreferenceUpdate(preference=PreferenceEnum.disliked))
+    assert await get_preferences_version(db_session, user_id) == version + 2
+    await delete_ingredient(db_session, user_id, ingredient)
+    assert await get_preferences_version(db_session, user_id) == version + 3
+
 @pytest.mark.asyncio(loop_scope="module")
 async def test_list_ingredients(db_session: AsyncSession):
     user_id = 5
@@ -164,4 +199,477 @@ async def test_create_recipes(db_session: AsyncSession):
         
     assert result is not None
     assert isinstance(result, RecipeList)
-    assert len(result.root) > 0
\ No newline at end of file
+    assert len(result.root) > 0
+
+class FakeRequest:
+    """Request stand-in whose client disconnects when asked to"""
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_run_generation_cancelled_on_client_disconnect():
+    upstream_cancelled = asyncio.Event()
+
+    async def generate():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            upstream_cancelled.set()
+            raise
+
+    cancelled_before = metrics.get_counter("llm_generations_cancelled_total")
+    request = FakeRequest()
+    waiter = asyncio.create_task(run_generation(request, "test-disconnect", generate))
+    await asyncio.sleep(0.05)
+    request.disconnected = True
+
+    with pytest.raises(ClientDisconnected):
+        await asyncio.wait_for(waiter, timeout=5)
+    await asyncio.wait_for(upstream_cancelled.wait(), timeout=5)
+    assert metrics.get_counter("llm_generations_cancelled_total") == cancelled_before + 1
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_run_generation_shared_until_last_waiter_leaves():
+    calls = 0
+
+    async def generate():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.5)
+        return "recipes"
+
+    leaving_request, staying_request = FakeRequest(), FakeRequest()
+    leaving = asyncio.create_task(run_generation(leaving_request, "test-shared", generate))
+    staying = asyncio.create_task(run_generation(staying_request, "test-shared", generate))
+    await asyncio.sleep(0.05)
+    leaving_request.disconnected = True
+
+    with pytest.raises(ClientDisconnected):
+        await leaving
+    # The remaining waiter still gets the result of the single upstream generation
+    assert await staying == "recipes"
+    assert calls == 1
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_shared_generation_creates_a_single_llm_client(monkeypatch):
+    created = []
+
+    class StubLLM:
+        def __init__(self, model, sync_client = True):
+            created.append(model)
+
+        async def agenerate_structured_response(self, prompt, response_schema, temperature, max_new_tokens, stream = False):
+            await asyncio.sleep(0.05)
+            return {"titles": ["Tomato Soup"]}
+
+        async def aclose(self):
+            pass
+
+    monkeypatch.setattr(endpoints_recipes, "GenericLLM", StubLLM)
+    results = await asyncio.gather(*(
+        endpoints_recipes._structured_generation(None, "stub-model", "system", "same prompt", RecipePlan, 256, user_id, RequestPriority.interactive)
+        for user_id in [16, 17, 18]
+    ))
+
+    # The requests waiting for the shared generation create no clients of their own
+    assert results == [{"titles": ["Tomato Soup"]}] * 3
+    assert created == ["stub-model"]
+
+def test_configure_db_pool_splits_the_connection_budget(monkeypatch):
+    for name in ["DB_POOL_SIZE", "DB_MAX_OVERFLOW", "DB_ECHO"]:
+        monkeypatch.delenv(name, raising=False)
+
+    # Each worker also has a LISTEN connection (to each shard) outside of its pool
+    assert configure_db_pool(4, 40) == 9
+    # No overflow: the pools can never exceed the budget
+    assert os.environ["DB_MAX_OVERFLOW"] == "0"
+    monkeypatch.delenv("DB_POOL_SIZE")
+    assert configure_db_pool(3, 40) == 12
+    monkeypatch.delenv("DB_POOL_SIZE")
+    # At least one connection per worker
+    assert configure_db_pool(8, 4) == 1
+    # An explicit pool size is kept
+    monkeypatch.setenv("DB_POOL_SIZE", "7")
+    assert configure_db_pool(4, 40) == 7
+
+def test_worker_shutdown_timeout_leaves_a_margin():
+    # The workers are only killed after the requests drain, leaving time for the lifespan shutdown
+    assert worker_shutdown_timeout(30) == 30 + 5
+
+def test_model_router_tiers():
+    router = ModelRouter(["small-model", "medium-model", "large-model"], small_tier_max_ingredients=5, large_tier_users=[42])
+
+    assert router.route(1, 3) == ["small-model", "medium-model", "large-model"]
+    # Requests with many ingredients skip the smallest tier
+    assert router.route(1, 8) == ["medium-model", "large-model"]
+    # Some users go straight to the largest tier
+    assert router.route(42, 3) == ["large-model"]
+
+def test_model_router_skips_invalid_large_tier_users(monkeypatch):
+    monkeypatch.setenv("LLM_MODEL_TIERS", "small-model,large-model")
+    monkeypatch.setenv("LLM_LARGE_TIER_USERS", "42, abc,7")
+
+    assert ModelRouter.from_env().large_tier_users == {42, 7}
+
+def test_json_schema_response_format_is_strict():
+    response_format = json_schema_response_format(RecipeList)
+
+    assert response_format["type"] == "json_schema"
+    assert response_format["json_schema"]["name"] == "RecipeList"
+    assert response_format["json_schema"]["strict"] is True
+    # Nested objects too: all their properties are required and no others are allowed
+    recipe_schema = response_format["json_schema"]["schema"]["$defs"]["Recipe"]
+    assert recipe_schema["additionalProperties"] is False
+    assert recipe_schema["required"] == list(recipe_schema["properties"])
+
+def test_split_recipes_salvages_valid_recipes():
+    recipe = {
+        "name": "Tomato salad",
+        "ingredients_quantities": [{"ingredient": "tomato", "quantity": 2}],
+        "instructions": ["Cut the tomatoes.", "Season them."],
+        "estimated_cooking_time": 10,
+        "difficulty_level": "Easy",
+        "calories": 120,
+        "servings": "2-3",
+    }
+    malformed_recipe = {"name": "Mystery dish", "servings": "a few"}
+
+    recipes, invalid_items = split_recipes({"recipes": [recipe, malformed_recipe]})
+
+    # The malformed recipe does not invalidate the rest, and common deviations are coerced
+    assert len(recipes) == 1
+    assert recipes[0].servings == 2
+    assert recipes[0].ingredients_quantities[0].quantity == "2"
+    assert recipes[0].calories == "120"
+    assert len(invalid_items) == 1
+    assert invalid_items[0][0] == malformed_recipe
+
+def test_drop_near_duplicate_recipes():
+    titles = ["Tomato Salad", "Tomato salad!", "Tomato Soup", "Caprese Salad", "Tomato Salads"]
+
+    assert drop_near_duplicates(titles) == ["Tomato Salad", "Tomato Soup", "Caprese Salad"]
+
+def stub_structured_generation(plans, recipe_names, calls):
+    """Stand-in of the LLM calls: returns the plan of each model, and a recipe named after the planned title (or recipe_names[title])"""
+    async def structured_generation(request, model, system_prompt, inst_prompt, response_schema, max_new_tokens, user_id, priority):
+        calls.append((model, response_schema.__name__))
+        if response_schema is RecipePlan:
+            return plans[model]
+        title = re.search(r'titled "(.+?)"', inst_prompt).group(1)
+        return {
+            "name": recipe_names.get(title, title),
+            "ingredients_quantities": [{"ingredient": "tomato", "quantity": "2"}],
+            "instructions": "Cook the tomatoes.",
+            "estimated_cooking_time": "20",
+            "difficulty_level": "Easy",
+            "calories": "150",
+            "servings": 2,
+        }
+
+    return structured_generation
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_create_recipes_parallel_plans_fans_out_and_dedups(db_session: AsyncSession, monkeypatch):
+    calls = []
+    plans = {"small-model": {"titles": ["Tomato Soup", "Cheese Omelette", "Onion Tart", "Tomato soup!"]}}
+    # Two calls may come up with the same recipe for different titles
+    monkeypatch.setattr(endpoints_recipes, "_structured_generation", stub_structured_generation(plans, {"Onion Tart": "Tomato Soup"}, calls))
+    monkeypatch.setattr(endpoints_recipes, "model_router", ModelRouter(["small-model", "large-model"]))
+
+    result = await create_recipes(15, ["tomato", "cheese", "onion"], db_session, mode=RecipesGenerationMode.parallel)
+
+    assert [recipe.name for recipe in result.root] == ["Tomato Soup", "Cheese Omelette"]
+    # A planning call, then one call per distinct planned title
+    assert calls[0] == ("small-model", "RecipePlan")
+    assert sorted(calls[1:]) == [("small-model", "Recipe")] * 3
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_create_recipes_parallel_escalates_empty_or_partial_plans(db_session: AsyncSession, monkeypatch):
+    monkeypatch.setattr(endpoints_recipes, "model_router", ModelRouter(["small-model", "large-model"]))
+    # An empty plan (no recipes) and a partial one (invalid structured output) of the small model
+    for small_model_plan in [{"titles": []}, {"recipes": "Tomato Soup"}]:
+        calls = []
+        plans = {"small-model": small_model_plan, "large-model": {"titles": ["Tomato Soup"]}}
+        monkeypatch.setattr(endpoints_recipes, "_structured_generation", stub_structured_generation(plans, {}, calls))
+
+        result = await create_recipes(15, ["tomato", "cheese", "onion"], db_session, mode=RecipesGenerationMode.parallel)
+
+        assert [recipe.name for recipe in result.root] == ["Tomato Soup"]
+        assert calls == [("small-model", "RecipePlan"), ("large-model", "RecipePlan"), ("large-model", "Recipe")]
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_create_recipes_does_not_escalate_configuration_errors(db_session: AsyncSession, monkeypatch):
+    models = []
+
+    async def structured_generation(request, model, *args):
+        models.append(model)
+        raise ValueError("The selected model is not deployed.")
+
+    monkeypatch.setattr(endpoints_recipes, "_structured_generation", structured_generation)
+    monkeypatch.setattr(endpoints_recipes, "model_router", ModelRouter(["small-model", "large-model"]))
+
+    with pytest.raises(ValueError, match="not deployed"):
+        await create_recipes(15, ["tomato", "cheese", "onion"], db_session, mode=RecipesGenerationMode.parallel)
+    # Only invalid outputs are escalated to the next tier
+    assert models == ["small-model"]
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_fair_scheduler_serves_users_round_robin():
+    scheduler = FairScheduler(capacity=1, per_user_limit=1, weights={3: 2})
+    served = []
+
+    async def job(user_id, priority=RequestPriority.interactive):
+        async with scheduler.slot(user_id, priority):
+            served.append(user_id)
+            await asyncio.sleep(0.01)
+
+    # Hold the only slot while the rest of the requests queue up
+    await scheduler.acquire(0)
+    jobs = [asyncio.create_task(job(1)) for _ in range(3)]
+    jobs += [asyncio.create_task(job(2)) for _ in range(2)]
+    jobs += [asyncio.create_task(job(3)) for _ in range(2)]
+    jobs.append(asyncio.create_task(job(4, RequestPriority.batch)))
+    await asyncio.sleep(0.01)
+    scheduler.release(0)
+    await asyncio.gather(*jobs)
+
+    # The burst of user 1 does not starve the others, user 3 has a weight of 2 and batch work goes last
+    assert served == [1, 2, 3, 3, 1, 2, 1, 4]
+    # Wait times are summarized per user only for the users with a configured weight
+    summaries = metrics.snapshot()["summaries"]
+    assert summaries['llm_user_queue_wait_seconds{user="3"}']["count"] == 2
+    assert 'llm_user_queue_wait_seconds{user="1"}' not in summaries
+
+def test_adaptive_concurrency_limiter():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=1, max_limit=10, latency_target=5)
+
+    assert limiter.try_acquire()
+    assert limiter.try_acquire()
+    # Over the limit: rejected right away
+    assert not limiter.try_acquire()
+
+    # Requests slower than the target shrink the limit, fast ones make it grow back
+    limiter.release(latency=10)
+    assert limiter.limit < 2
+    limiter.release(latency=1)
+    for _ in range(20):
+        assert limiter.try_acquire()
+        limiter.release(latency=1)
+    assert limiter.limit >= 2
+    assert limiter.retry_after() >= 1
+
+def test_consistent_hash_ring_moves_few_users():
+    users = range(1, 3001)
+    ring = ConsistentHashRing(["shard0", "shard1"])
+    new_ring = ConsistentHashRing(["shard0", "shard1", "shard2"])
+
+    # The users are spread evenly, and adding a shard only moves users to the new one (about a third of them)
+    assert 1200 < sum(ring.shard_for(user_id) == "shard0" for user_id in users) < 1800
+    moved = [user_id for user_id in users if ring.shard_for(user_id) != new_ring.shard_for(user_id)]
+    assert all(new_ring.shard_for(user_id) == "shard2" for user_id in moved)
+    assert 700 < len(moved) < 1300
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_rebalance_moves_users_to_new_shard(tmp_path):
+    pytest.importorskip("aiosqlite")
+    database = ShardedDatabase.from_urls({name: f"sqlite+aiosqlite:///{tmp_path}/{name}.db" for name in ["shard0", "shard1", "shard2"]}, echo=False)
+    await database.create_all()
+    old_database = ShardedDatabase({name: database.engines[name] for name in ["shard0", "shard1"]})
+    try:
+        for user_id in range(1, 51):
+            async with old_database.session(user_id) as db:
+                await create_ingredient(db, IngredientPreferenceCreate(user_id=user_id, ingredient="tomato", preference=PreferenceEnum.liked))
+                version = await get_preferences_version(db, user_id)
+
+        report = await rebalance(database, database.ring)
+        assert sum(users for users, _ in report.values()) > 0
+        assert all(target == "shard2" for _, target in report)
+        # Every user is found in its new shard (and its version never goes back)
+        for user_id in range(1, 51):
+            async with database.session(user_id) as db:
+                assert (await get_ingredient(db, user_id, "tomato")) is not None
+                assert await get_preferences_version(db, user_id) >= version
+        assert await rebalance(database, database.ring) == {}
+    finally:
+        await database.dispose()
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_user_cache_does_not_store_stale_loads():
+    cache = UserCache(ttl=60, max_users=10)
+    cache.enabled = True
+
+    async def load_racing_with_write():
+        # The user is written (and evicted) while its old value is being loaded
+        cache.evict_user(1)
+        return "old"
+
+    assert await cache.get_or_load(1, "version", load_racing_with_write) == "old"
+    assert await cache.get_or_load(1, "version", lambda: asyncio.sleep(0, "new")) == "new"
+    assert await cache.get_or_load(1, "version", lambda: asyncio.sleep(0, "newer")) == "new"
+    cache.clear()
+    assert await cache.get_or_load(1, "version", lambda: asyncio.sleep(0, "newer")) == "newer"
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_invalidation_listener_evicts_writes_of_other_workers(db_session: AsyncSession):
+    if db_session.bind.dialect.name != "postgresql":
+        pytest.skip("The invalidation bus requires PostgreSQL")
+    user_id = 10
+    # The cache of another worker, listening to the writes of this one
+    cache = UserCache(ttl=60, max_users=10)
+    listener = InvalidationListener(shards, cache)
+    await listener.start()
+    try:
+        for _ in range(100):
+            if cache.enabled:
+                break
+            await asyncio.sleep(0.05)
+        assert cache.enabled
+        loads = 0
+
+        async def load_version():
+            nonlocal loads
+            loads += 1
+            return await get_preferences_version(db_session, user_id)
+
+        version = await cache.get_or_load(user_id, "version", load_version)
+        assert await cache.get_or_load(user_id, "version", load_version) == version
+        assert loads == 1
+
+        # Once the write is notified, the cached version is evicted and the new one is loaded
+        await create_ingredient(db_session, IngredientPreferenceCreate(user_id=user_id, ingredient="tomato", preference=PreferenceEnum.liked))
+        for _ in range(100):
+            if await cache.get_or_load(user_id, "version", load_version) != version:
+                break
+            await asyncio.sleep(0.01)
+        assert await cache.get_or_load(user_id, "version", load_version) == version + 1
+        assert loads == 2
+    finally:
+        await listener.stop()
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_group_commit_writer(db_session: AsyncSession):
+    user_id = 14
+    writer = GroupCommitWriter(lambda: shards.session(user_id), window=0.05)
+    version = await get_preferences_version(db_session, user_id)
+    try:
+        # Concurrent writes of the same preference, committed together in a single transaction
+        results = await asyncio.gather(
+            writer.submit("create", user_id, "tomato", PreferenceEnum.liked),
+            writer.submit("create", user_id, "tomato", PreferenceEnum.liked),
+            writer.submit("create", user_id, "tomato", PreferenceEnum.disliked),
+            writer.submit("update", user_id, "tomato", PreferenceEnum.disliked),
+            writer.submit("update", user_id, "onion", PreferenceEnum.liked),
+            return_exceptions=True
+        )
+    finally:
+        await writer.close()
+
+    # Each write gets the result it would have got if executed on its own, one after the other
+    assert [result.status_code if isinstance(result, HTTPException) else result.preference for result in results] == [
+        PreferenceEnum.liked, PreferenceEnum.liked, 400, PreferenceEnum.disliked, 404
+    ]
+    assert len({result.id for result in results if not isinstance(result, HTTPException)}) == 1
+    record = await get_ingredient(db_session, user_id, "tomato")
+    assert record.preference.value == PreferenceEnum.disliked
+    assert await get_preferences_version(db_session, user_id) == version + 1
+
+def test_profile_path_rejects_invalid_names(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path / "profiles"))
+    os.makedirs(profiling.PROFILING_DIR)
+    name = "20250101T000000000000Z_GET_recipes_2500ms_slow" + profiling.PROFILE_SUFFIX
+    (tmp_path / "profiles" / name).write_text("{}")
+    (tmp_path / ("outside" + profiling.PROFILE_SUFFIX)).write_text("{}")
+
+    assert profiling.profile_path(name) == os.path.join(profiling.PROFILING_DIR, name)
+    # Path traversal, other files and unknown profiles
+    assert profiling.profile_path("../outside" + profiling.PROFILE_SUFFIX) is None
+    assert profiling.profile_path("/etc/passwd") is None
+    assert profiling.profile_path("notes.txt") is None
+    assert profiling.profile_path("missing" + profiling.PROFILE_SUFFIX) is None
+
+def test_saved_profiles_are_rotated(tmp_path, monkeypatch):
+    pyinstrument = pytest.importorskip("pyinstrument")
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "PROFILING_MAX_FILES", 3)
+    profiler = pyinstrument.Profiler()
+    profiler.start()
+    profiler.stop()
+
+    names = [f"2025010{day}T000000000000Z_GET_recipes_10ms_sampled{profiling.PROFILE_SUFFIX}" for day in range(1, 6)]
+    for name in names:
+        profiling._save_profile(profiler, name)
+
+    # Only the newest ones are kept
+    assert [profile["name"] for profile in profiling.list_profiles()] == names[:1:-1]
+
+class RacingGroupCommitWriter(GroupCommitWriter):
+    """Group commit writer some other write inserts a preference for right after it read the existing ones"""
+    def __init__(self, session_factory, racing_preference, **kwargs) -> None:
+        super().__init__(session_factory, **kwargs)
+        self.racing_preference = racing_preference
+
+    async def _lock_existing(self, db, keys):
+        existing = await super()._lock_existing(db, keys)
+        if self.racing_preference is not None:
+            await db.execute(insert(IngredientPreference).values(**self.racing_preference))
+            self.racing_preference = None
+        return existing
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_group_commit_writer_does_not_overwrite_concurrent_inserts(db_session: AsyncSession):
+    user_id = 20
+    racing_preference = {"user_id": user_id, "ingredient": "tomato", "preference": PreferenceEnum.disliked}
+    writer = RacingGroupCommitWriter(lambda: shards.session(user_id), racing_preference, window=0.05)
+    try:
+        results = await asyncio.gather(
+            writer.submit("create", user_id, "tomato", PreferenceEnum.liked),
+            writer.submit("create", user_id, "onion", PreferenceEnum.liked),
+            return_exceptions=True
+        )
+    finally:
+        await writer.close()
+
+    # The contradictory create is rejected instead of overwriting the preference inserted in the meantime
+    assert isinstance(results[0], HTTPException) and results[0].status_code == 400
+    assert results[1].preference == PreferenceEnum.liked
+    assert (await get_ingredient(db_session, user_id, "tomato")).preference == PreferenceEnum.disliked
+    assert (await get_ingredient(db_session, user_id, "onion")).preference == PreferenceEnum.liked
+
+async def parse_csv(body, chunk_size = 7):
+    """Parses a CSV body received in small chunks
+
+    Returns:
+        list of tuples: (line number, ingredient) of the valid rows, (line number, error) of the invalid ones
+    """
+    async def chunks():
+        data = body.encode()
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    return [
+        (line_number, preference.ingredient if preference is not None else error)
+        async for line_number, preference, error in ingredient_preferences_bulk._parse_preferences(chunks(), BulkFormat.csv)
+    ]
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_parse_csv_quoted_fields():
+    body = 'user_id,ingredient,preference\n9,"herbes de\nprovence",liked\n9,"say ""cheese""",liked\n9,5" pizza,liked\n9,a,liked\n9,b,liked\n'
+
+    # Quotes only open a quoted field at its start: a stray one is a literal character and does not swallow the next rows
+    assert await parse_csv(body) == [(2, "herbes de\nprovence"), (4, 'say "cheese"'), (5, '5" pizza'), (6, "a"), (7, "b")]
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_parse_csv_unclosed_quote(monkeypatch):
+    rows = await parse_csv('user_id,ingredient,preference\n9,a,liked\n9,"never closed,liked\n9,b,liked\n')
+    assert rows[0] == (2, "a")
+    assert rows[1][0] == 3 and "unclosed quoted field" in rows[1][1]
+    assert len(rows) == 2
+
+    # The buffered record is bounded: the rest of the stream is parsed again once it is reported
+    monkeypatch.setattr(ingredient_preferences_bulk, "MAX_RECORD_SIZE", 40)
+    rows = await parse_csv('user_id,ingredient,preference\n9,"never closed,liked\n9,a,liked\n9,b,liked\n9,c,liked\n')
+    assert rows[0][0] == 2 and "longer than 40 characters" in rows[0][1]
+    assert rows[1:] == [(5, "c")]